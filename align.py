@@ -0,0 +1,48 @@
+# Aligns the line crops cut by pdf2img with the bars of a normalized midi
+# timeline (see midinorm), so that each line image can fetch its notes
+# without recomputing the alignment.
+from pathlib import Path
+
+import numpy as np
+
+# Columns of an alignment row.
+CLOCK_START, CLOCK_END, NOTE_START, NOTE_END = range(4)
+
+
+def align_lines(
+    bar_counts: np.ndarray,
+    bars: np.ndarray,
+    clocks: np.ndarray,
+    first_bar: int = 0
+) -> np.ndarray:
+    # For each line, holding bar_counts[i] bars, returns a row of the clock
+    # range [start, end) it covers in the performance and the range of notes
+    # starting within it. BARS are the bar boundaries as returned by
+    # midi.index.bar_clocks, CLOCKS the sorted note clocks of the timeline and
+    # FIRST_BAR the performance bar the first line starts on.
+    bounds = first_bar + np.concatenate(([0], np.cumsum(bar_counts)))
+    if bounds[-1] >= len(bars):
+        raise ValueError(
+            f"Lines hold {bounds[-1] - first_bar} bars, "
+            f"the performance only {len(bars) - 1 - first_bar}.")
+    alignment = np.empty((len(bar_counts), 4), dtype=np.int64)
+    alignment[:, CLOCK_START] = bars[bounds[:-1]]
+    alignment[:, CLOCK_END] = bars[bounds[1:]]
+    alignment[:, NOTE_START] = np.searchsorted(
+        clocks, alignment[:, CLOCK_START], side="left")
+    alignment[:, NOTE_END] = np.searchsorted(
+        clocks, alignment[:, CLOCK_END], side="left")
+    return alignment
+
+
+def line_notes(notes: np.ndarray, alignment: np.ndarray, line: int) -> np.ndarray:
+    # The notes starting in LINE, as a view into NOTES.
+    return notes[alignment[line, NOTE_START]:alignment[line, NOTE_END]]
+
+
+def save_alignment(target: Path | str, alignment: np.ndarray):
+    np.save(target, np.ascontiguousarray(alignment, dtype=np.int64))
+
+
+def load_alignment(source: Path | str) -> np.ndarray:
+    return np.load(source, mmap_mode="r")
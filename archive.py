@@ -0,0 +1,249 @@
+# Corpora stored as zip or tar archives, read in place rather than extracted.
+# A Member names a file within an archive, and a Reader reads the content of
+# plain files and members alike, opening each archive only once.
+import hashlib
+import io
+import tarfile
+import time
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from pathlib import Path, PurePosixPath
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+import profiling
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+# Most zip archive members handed to a worker at once, see map_slices.
+SLICE_SIZE = 256
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class Member:
+    archive: Path
+    name: str
+    # As recorded in the archive, the modification time in nanoseconds.
+    size: int = field(default=-1, compare=False)
+    mtime: int = field(default=-1, compare=False)
+
+    @property
+    def stem(self) -> str:
+        return PurePosixPath(self.name).stem
+
+    @property
+    def suffix(self) -> str:
+        return PurePosixPath(self.name).suffix
+
+    def __str__(self) -> str:
+        return f"{self.archive}:{self.name}"
+
+
+Source = Path | Member
+
+
+def is_archive(path: Path | str) -> bool:
+    return str(path).lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def is_zip(path: Path | str) -> bool:
+    return str(path).lower().endswith(".zip")
+
+
+def open_archive(path: Path | str) -> zipfile.ZipFile | tarfile.TarFile:
+    # Tar archives are opened as streams, to be read from start to end: a
+    # compressed one can't be read otherwise without decompressing it again
+    # for each member, and indexing them means reading them whole.
+    if is_zip(path):
+        return zipfile.ZipFile(path)
+    return tarfile.open(path, "r|*")
+
+
+def members(
+    path: Path | str,
+    suffixes: Optional[Sequence[str]] = None
+) -> List[Member]:
+    # The files of archive PATH ending with one of SUFFIXES (all of them when
+    # None), in archive order.
+    path = Path(path)
+    with open_archive(path) as archive:
+        if isinstance(archive, zipfile.ZipFile):
+            found = [zip_member(path, info) for info in archive.infolist()
+                     if not info.is_dir()]
+        else:
+            found = [tar_member(path, info) for info in archive if info.isfile()]
+    return [member for member in found
+            if suffixes is None or member.suffix.lower() in suffixes]
+
+
+def zip_member(path: Path, info: zipfile.ZipInfo) -> Member:
+    # Zip archives store local times with a two second resolution.
+    mtime = int(time.mktime(info.date_time + (0, 0, -1)))
+    return Member(path, info.filename, info.file_size, mtime * 10**9)
+
+
+def tar_member(path: Path, info: tarfile.TarInfo) -> Member:
+    return Member(path, info.name, info.size, int(info.mtime) * 10**9)
+
+
+def next_member(archive: tarfile.TarFile, name: str) -> Optional[tarfile.TarInfo]:
+    # Reads ARCHIVE on up to its member NAME, None when not found before the
+    # end.
+    info = archive.next()
+    while info is not None and info.name != name:
+        info = archive.next()
+    return info
+
+
+class Reader:
+    # Reads plain files and archive members, keeping the archives it opened
+    # open until closed. Members of a tar archive are read on from the last
+    # one read, the archive being read again from its start for a member
+    # before it, so they are best read in archive order. The digest of
+    # everything read is kept in DIGESTS, see manifest.
+
+    archives: Dict[Path, zipfile.ZipFile | tarfile.TarFile]
+    digests: Dict[Source, str]
+
+    def __init__(self):
+        self.archives = {}
+        self.digests = {}
+
+    def read(self, source: Source) -> bytes:
+        data = self.read_raw(source)
+        self.digests[source] = digest(data)
+        return data
+
+    def read_raw(self, source: Source) -> bytes:
+        if isinstance(source, Path):
+            return source.read_bytes()
+        archive = self.archives.get(source.archive)
+        if archive is None:
+            archive = self.archives[source.archive] = open_archive(
+                source.archive)
+        if isinstance(archive, zipfile.ZipFile):
+            return archive.read(source.name)
+        info = next_member(archive, source.name)
+        if info is None:
+            # Past the end, or the member is before the last one read.
+            archive.close()
+            archive = self.archives[source.archive] = open_archive(
+                source.archive)
+            info = next_member(archive, source.name)
+        if info is None:
+            raise KeyError(f"No member {source.name} in {source.archive}.")
+        file = archive.extractfile(info)
+        if file is None:
+            raise ValueError(f"{source} is not a file.")
+        with file:
+            return file.read()
+
+    def text(self, source: Source, encoding: str = "utf-8") -> io.StringIO:
+        # The content as a text stream, named after SOURCE for messages.
+        stream = io.StringIO(self.read(source).decode(encoding))
+        stream.name = str(source)
+        return stream
+
+    def close(self):
+        for archive in self.archives.values():
+            archive.close()
+        self.archives.clear()
+
+    def __enter__(self) -> "Reader":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def iter_members(
+    path: Path | str,
+    suffixes: Optional[Sequence[str]] = None
+) -> Iterator[Tuple[Member, bytes]]:
+    # Each member of archive PATH ending with one of SUFFIXES along with its
+    # content, reading the archive once from start to end.
+    path = Path(path)
+    with open_archive(path) as archive:
+        if isinstance(archive, zipfile.ZipFile):
+            for info in archive.infolist():
+                member = zip_member(path, info)
+                if not info.is_dir() and (
+                        suffixes is None or member.suffix.lower() in suffixes):
+                    yield member, archive.read(info)
+        else:
+            for info in archive:
+                member = tar_member(path, info)
+                if not info.isfile() or (
+                        suffixes is not None and
+                        member.suffix.lower() not in suffixes):
+                    continue
+                file = archive.extractfile(info)
+                if file is not None:
+                    with file:
+                        yield member, file.read()
+
+
+def slices(
+    sources: Sequence[Source],
+    size: int,
+    jobs: int = 1
+) -> List[List[Source]]:
+    # Splits SOURCES into lists of at most SIZE members of the same archive,
+    # each plain file making its own list, so that a worker opens each
+    # archive once per slice. As each slice of a tar archive reads it from
+    # its start, the members of a tar archive are rather split into JOBS
+    # lists, making a single pass over the archive per worker.
+    sizes = Counter(source.archive for source in sources
+                    if isinstance(source, Member) and not is_zip(source.archive))
+    out: List[List[Source]] = []
+    for source in sources:
+        if (isinstance(source, Member) and out and
+                isinstance(out[-1][-1], Member) and
+                out[-1][-1].archive == source.archive and
+                len(out[-1]) < (size if is_zip(source.archive) else
+                                -(-sizes[source.archive] // jobs))):
+            out[-1].append(source)
+        else:
+            out.append([source])
+    return out
+
+
+def map_slices(
+    fn: Callable[[List[Source]], List[T]],
+    sources: Sequence[Source],
+    jobs: int = 1,
+    profile: Optional[Path] = None
+) -> Iterator[T]:
+    # Applies FN to slices of SOURCES in JOBS processes, inline for a single
+    # job, and yields the results in order. Slices are sized to make a few
+    # per worker, so that the load stays balanced. With PROFILE, FN is
+    # profiled into it, see profiling.Session.
+    size = max(1, min(SLICE_SIZE, -(-len(sources) // (4 * jobs))))
+    units = slices(sources, size, jobs)
+    with ExitStack() as stack:
+        session = stack.enter_context(profiling.Session(profile))
+        task = session.wrap(fn)
+        if jobs == 1 or len(units) < 2:
+            outputs = map(task, units)
+        else:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=jobs))
+            outputs = pool.map(task, units)
+        for output in outputs:
+            yield from session.collect(output)
@@ -0,0 +1,71 @@
+# Augmented variants of a normalized timeline (see midinorm.NOTE_DTYPE):
+# transpositions, tempo scaling and velocity jitter, computed for all the
+# variants at once by broadcasting over a (variants, notes) array instead of
+# decoding and writing the midi file again for each of them.
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from midi.output import MidiOutput
+from midi.typing import NOTES
+from midinorm import NOTE_DTYPE
+
+
+def grid(
+    shifts: Sequence[int],
+    scales: Sequence[float] = (1.0,)
+) -> Tuple[np.ndarray, np.ndarray]:
+    # All combinations of SHIFTS and SCALES, as the arguments of variants().
+    shift, scale = np.meshgrid(np.asarray(shifts, dtype=np.int64),
+                               np.asarray(scales, dtype=np.float64))
+    return shift.ravel(), scale.ravel()
+
+
+def variants(
+    notes: np.ndarray,
+    shifts: Sequence[int] | np.ndarray = (0,),
+    scales: Sequence[float] | np.ndarray = (1.0,),
+    jitter: int = 0,
+    seed: Optional[int] = None
+) -> np.ndarray:
+    # Returns a (K, len(NOTES)) NOTE_DTYPE array, K being the broadcast
+    # length of SHIFTS and SCALES. Variant k transposes all notes by
+    # shifts[k] semitones, clamped to the midi note range, scales clocks and
+    # durations by scales[k], keeping notes at least one tick long, and adds
+    # a uniform jitter in [-JITTER, JITTER] to velocities, clamped to
+    # [1, 127] so that note ons stay note ons.
+    shifts, scales = np.broadcast_arrays(
+        np.asarray(shifts, dtype=np.int64), np.asarray(scales, dtype=np.float64))
+    shifts, scales = shifts.reshape(-1, 1), scales.reshape(-1, 1)
+    out = np.empty((len(shifts), len(notes)), dtype=NOTE_DTYPE)
+    clocks = notes["clock"].astype(np.float64)
+    ends = clocks + notes["duration"]
+    out["clock"] = np.rint(clocks * scales)
+    out["duration"] = np.maximum(np.rint(ends * scales) - out["clock"],
+                                 np.minimum(notes["duration"], 1))
+    out["note"] = np.clip(notes["note"].astype(np.int64) + shifts,
+                          0, len(NOTES) - 1)
+    out["channel"] = notes["channel"]
+    velocities = np.broadcast_to(notes["velocity"].astype(np.int64), out.shape)
+    if jitter:
+        rng = np.random.default_rng(seed)
+        velocities = velocities + rng.integers(-jitter, jitter + 1, out.shape)
+    out["velocity"] = np.clip(velocities, 1, 127)
+    return out
+
+
+def render(
+    notes: np.ndarray,
+    divisions: int = 480,
+    bpm: int = 120,
+    signature: Optional[Tuple[int, int]] = None
+) -> MidiOutput:
+    # Writes a single variant back into a format 0 midi file, SIGNATURE
+    # being the (numerator, denominator) of its time signature.
+    output = MidiOutput()
+    output.write_format0(
+        notes["clock"].tolist(), notes["duration"].tolist(),
+        notes["note"].tolist(), notes["channel"].tolist(),
+        notes["velocity"].tolist(), divisions, bpm, signature,
+    )
+    return output
@@ -0,0 +1,380 @@
+# Catalog of the metadata of midi and kern files in a SQLite database, so
+# that selecting files of a corpus, e.g. those in 3/4 with more than two
+# tracks, is a query rather than a parse of every file:
+#
+#   SELECT path FROM files JOIN midi USING (file_id)
+#   JOIN meters USING (file_id)
+#   WHERE numerator = 3 AND denominator = 4 AND tracks > 2;
+#
+# Files are only scanned for their header, meta events and note counts,
+# skipping everything else by length, and are rescanned only when their size
+# or modification time changed since the catalog last saw them.
+import array
+import re
+import sqlite3
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import profiling
+from archive import Member, Reader, Source, map_slices
+from manifest import key, stat
+from midi.input import TrackScanner
+from midi.typing import EventType
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    archive TEXT,               -- For archive members, NULL otherwise.
+    kind TEXT NOT NULL,         -- 'midi' or 'kern'.
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,     -- In nanoseconds.
+    digest TEXT,
+    error TEXT                  -- Why the scan failed, NULL when it didn't.
+);
+CREATE TABLE IF NOT EXISTS midi (
+    file_id INTEGER PRIMARY KEY REFERENCES files ON DELETE CASCADE,
+    format INTEGER NOT NULL,
+    tracks INTEGER NOT NULL,
+    divisions INTEGER NOT NULL,
+    notes INTEGER NOT NULL,
+    channels INTEGER NOT NULL,  -- Channels playing notes.
+    ticks INTEGER NOT NULL,     -- Tick of the last event.
+    seconds REAL NOT NULL,
+    bpm REAL                    -- Initial tempo, NULL when not set.
+);
+CREATE TABLE IF NOT EXISTS kern (
+    file_id INTEGER PRIMARY KEY REFERENCES files ON DELETE CASCADE,
+    spines INTEGER NOT NULL,    -- At the start.
+    max_spines INTEGER NOT NULL,
+    splits INTEGER NOT NULL,    -- Spine splits (*^) and merges (*v).
+    merges INTEGER NOT NULL,
+    bars INTEGER NOT NULL,
+    notes INTEGER NOT NULL,
+    lines INTEGER NOT NULL
+);
+-- Time signatures and key signatures, at a tick of midi files or a line of
+-- kern files.
+CREATE TABLE IF NOT EXISTS meters (
+    file_id INTEGER NOT NULL REFERENCES files ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    numerator INTEGER NOT NULL,
+    denominator INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS keys (
+    file_id INTEGER NOT NULL REFERENCES files ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    sharps INTEGER NOT NULL,    -- Negative for flats.
+    minor INTEGER               -- NULL when unknown.
+);
+CREATE TABLE IF NOT EXISTS tempos (
+    file_id INTEGER NOT NULL REFERENCES files ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    bpm REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_archive ON files (archive);
+CREATE INDEX IF NOT EXISTS files_kind ON files (kind);
+CREATE INDEX IF NOT EXISTS midi_tracks ON midi (tracks);
+CREATE INDEX IF NOT EXISTS midi_seconds ON midi (seconds);
+CREATE INDEX IF NOT EXISTS kern_spines ON kern (spines, max_spines);
+CREATE INDEX IF NOT EXISTS kern_splits ON kern (splits);
+CREATE INDEX IF NOT EXISTS meters_file ON meters (file_id);
+CREATE INDEX IF NOT EXISTS meters_meter ON meters (numerator, denominator);
+CREATE INDEX IF NOT EXISTS keys_file ON keys (file_id);
+CREATE INDEX IF NOT EXISTS keys_key ON keys (sharps, minor);
+CREATE INDEX IF NOT EXISTS tempos_file ON tempos (file_id);
+"""
+
+KERN_SUFFIXES = (".krn",)
+
+# Default tempo of midi files, in microseconds per quarter note.
+DEFAULT_TEMPO = 500_000
+
+
+@dataclass
+class MidiInfo:
+    format: int = 0
+    tracks: int = 0
+    divisions: int = 0
+    notes: int = 0
+    channels: int = 0
+    ticks: int = 0
+    seconds: float = 0.0
+    # As (tick, value) tuples.
+    meters: List[Tuple[int, int, int]] = field(default_factory=list)
+    keys: List[Tuple[int, int, Optional[int]]] = field(default_factory=list)
+    tempos: List[Tuple[int, int]] = field(default_factory=list)  # us/quarter.
+
+
+@dataclass
+class KernInfo:
+    spines: int = 0
+    max_spines: int = 0
+    splits: int = 0
+    merges: int = 0
+    bars: int = 0
+    notes: int = 0
+    lines: int = 0
+    # As (line, value) tuples.
+    meters: List[Tuple[int, int, int]] = field(default_factory=list)
+    keys: List[Tuple[int, int, Optional[int]]] = field(default_factory=list)
+
+
+class MetaScanner(TrackScanner):
+    # Reads meta events and counts note ons.
+
+    channels: int = 0   # Bit mask of the channels playing notes.
+    info: MidiInfo
+
+    def scan_track(self, start: int, length: int, info: MidiInfo) -> int:
+        # Adds the meta events and notes of the track chunk at START to INFO,
+        # returns the tick of its last event.
+        self.info = info
+        return self.walk_track(start, length)
+
+    def meta(self, tick: int, meta_type: int, size: int):
+        buf, pos = self.buf, self.pos
+        if meta_type == EventType.Tempo.code():
+            self.info.tempos.append((tick, (buf[pos] << 16) |
+                                     (buf[pos + 1] << 8) | buf[pos + 2]))
+        elif meta_type == EventType.TimeSignature.code():
+            self.info.meters.append((tick, buf[pos], 2 ** buf[pos + 1]))
+        elif meta_type == EventType.KeySignature.code():
+            # Sharps are a signed byte.
+            self.info.keys.append((tick, (buf[pos] ^ 0x80) - 0x80,
+                                   int(buf[pos + 1] == 1)))
+
+    def channel(self, tick: int, status: int):
+        # Note ons of zero velocity are note offs.
+        if (status & 0xF0) == EventType.NoteOn.code() and self.buf[self.pos + 1]:
+            self.info.notes += 1
+            self.channels |= 1 << (status & 0x0F)
+
+
+def seconds(tempos: Sequence[Tuple[int, int]], divisions: int, end: int) -> float:
+    # Duration of the first END ticks given the tempo changes as (tick,
+    # microseconds per quarter) tuples.
+    changes = sorted(tempos)
+    if not changes or changes[0][0] > 0:
+        changes.insert(0, (0, DEFAULT_TEMPO))
+    total = 0
+    for idx, (tick, tempo) in enumerate(changes):
+        stop = changes[idx + 1][0] if idx + 1 < len(changes) else end
+        total += max(0, min(stop, end) - tick) * tempo
+    return total / (divisions * 1_000_000) if divisions else 0.0
+
+
+def scan_midi(data: bytes) -> MidiInfo:
+    scanner = MetaScanner(array.array("B", data))
+    header, tracks = scanner.scan_chunks()
+    scanner.pos = header + 8
+    info = MidiInfo(
+        format=scanner.read_u16(),
+        tracks=scanner.read_u16(),
+        divisions=scanner.read_u16(),
+    )
+    if info.divisions & 0x8000:
+        raise ValueError("SMPTE divisions aren't supported.")
+    info.ticks = max((scanner.scan_track(start, length, info)
+                      for start, length in tracks), default=0)
+    info.channels = scanner.channels.bit_count()
+    info.seconds = seconds(info.tempos, info.divisions, info.ticks)
+    info.meters.sort()
+    info.keys.sort()
+    info.tempos.sort()
+    return info
+
+
+METER_RE = re.compile(r"^\*M(\d+)/(\d+)$")
+METRICAL_RE = re.compile(r"^\*met\((C\|?)\)$")
+SIGNATURE_RE = re.compile(r"^\*k\[([a-gA-G#-]*)\]$")
+MODE_RE = re.compile(r"^\*([a-gA-G])[#-]?:")
+NOTE_RE = re.compile(r"[a-gA-G]")
+
+
+def scan_kern(text: str) -> KernInfo:
+    # Reads the spine layout and interpretations of a kern file, without
+    # parsing its notes.
+    info = KernInfo()
+    # The exclusive interpretation of each spine, e.g. **kern or **dynam.
+    spines: List[str] = []
+    minor = None
+    for lineno, line in enumerate(text.splitlines(), start=1):
+        info.lines = lineno
+        if not line or line.startswith("!"):
+            continue
+        tokens = line.split("\t")
+        if line.startswith("**"):
+            spines = tokens
+            info.spines = info.max_spines = len(spines)
+        elif line.startswith("*"):
+            meters, keys = set(), set()
+            merging, next_spines = False, []
+            for spine, token in zip(spines, tokens):
+                if token == "*^":
+                    info.splits += 1
+                    next_spines.extend((spine, spine))
+                elif token == "*v":
+                    # Adjacent *v merge into one spine.
+                    if not merging:
+                        info.merges += 1
+                        next_spines.append(spine)
+                elif token != "*-":
+                    next_spines.append(spine)
+                if m := METER_RE.match(token):
+                    meters.add((int(m.group(1)), int(m.group(2))))
+                elif m := METRICAL_RE.match(token):
+                    meters.add((4, 4) if m.group(1) == "C" else (2, 2))
+                elif m := SIGNATURE_RE.match(token):
+                    keys.add(m.group(1).count("#") - m.group(1).count("-"))
+                elif m := MODE_RE.match(token):
+                    minor = int(m.group(1).islower())
+                merging = token == "*v"
+            spines = next_spines
+            info.max_spines = max(info.max_spines, len(spines))
+            info.meters.extend((lineno, *meter) for meter in sorted(meters))
+            info.keys.extend((lineno, sharps, minor) for sharps in sorted(keys))
+            # Modes usually follow the key signature.
+            if minor is not None and info.keys and info.keys[-1][2] is None:
+                info.keys[-1] = (*info.keys[-1][:2], minor)
+        elif line.startswith("="):
+            info.bars += 1
+        else:
+            info.notes += sum(
+                1 for spine, token in zip(spines, tokens)
+                if spine == "**kern" and token != "."
+                for note in token.split()
+                if "r" not in note and NOTE_RE.search(note))
+    return info
+
+
+@dataclass
+class Scan:
+    source: Source
+    size: int
+    mtime: int
+    digest: Optional[str] = None
+    info: Optional[MidiInfo | KernInfo] = None
+    error: Optional[str] = None
+
+
+def kind(source: Source) -> str:
+    return "kern" if source.suffix.lower() in KERN_SUFFIXES else "midi"
+
+
+def scan_sources(sources: List[Source]) -> List[Scan]:
+    # Scans SOURCES, turning failures into the error of their scan.
+    scans = []
+    with Reader() as reader:
+        for source in sources:
+            scan = Scan(source, *stat(source))
+            try:
+                data = reader.read(source)
+                scan.digest = reader.digests.pop(source)
+                with profiling.timer(f"catalog.{kind(source)}"):
+                    scan.info = (scan_kern(data.decode())
+                                 if kind(source) == "kern" else scan_midi(data))
+            except Exception as e:
+                scan.error = f"{type(e).__name__}: {e}"
+            scans.append(scan)
+    return scans
+
+
+def connect(path: Path | str) -> sqlite3.Connection:
+    # Opens the catalog at PATH, creating it if needed.
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA foreign_keys = ON")
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def stale(connection: sqlite3.Connection, sources: Sequence[Source]) -> List[Source]:
+    # The sources not in the catalog, or whose size or time changed.
+    known: Dict[str, Tuple[int, int]] = {
+        path: (size, mtime) for path, size, mtime in
+        connection.execute("SELECT path, size, mtime FROM files")
+    }
+    return [source for source in sources
+            if known.get(key(source)) != stat(source)]
+
+
+def store(connection: sqlite3.Connection, scan: Scan):
+    source = scan.source
+    connection.execute("DELETE FROM files WHERE path = ?", (key(source),))
+    archive = (str(source.archive.resolve()) if isinstance(source, Member)
+               else None)
+    file_id = connection.execute(
+        "INSERT INTO files (path, archive, kind, size, mtime, digest, error) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (key(source), archive, kind(source), scan.size, scan.mtime,
+         scan.digest, scan.error),
+    ).lastrowid
+    info = scan.info
+    if isinstance(info, MidiInfo):
+        connection.execute(
+            "INSERT INTO midi VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (file_id, info.format, info.tracks, info.divisions, info.notes,
+             info.channels, info.ticks, info.seconds,
+             60_000_000 / info.tempos[0][1]
+             if info.tempos and info.tempos[0][0] == 0 else None),
+        )
+        connection.executemany(
+            "INSERT INTO tempos VALUES (?, ?, ?)",
+            [(file_id, tick, 60_000_000 / tempo)
+             for tick, tempo in info.tempos if tempo])
+    elif isinstance(info, KernInfo):
+        connection.execute(
+            "INSERT INTO kern VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (file_id, info.spines, info.max_spines, info.splits, info.merges,
+             info.bars, info.notes, info.lines),
+        )
+    if info is not None:
+        connection.executemany(
+            "INSERT INTO meters VALUES (?, ?, ?, ?)",
+            [(file_id, *meter) for meter in info.meters])
+        connection.executemany(
+            "INSERT INTO keys VALUES (?, ?, ?, ?)",
+            [(file_id, *signature) for signature in info.keys])
+
+
+def scan_all(
+    sources: Sequence[Source],
+    jobs: int = 1,
+    profile: Optional[Path] = None
+) -> Iterator[Scan]:
+    # Scans SOURCES in JOBS processes, in order, see archive.map_slices.
+    return map_slices(scan_sources, sources, jobs, profile)
+
+
+def refresh(
+    connection: sqlite3.Connection,
+    sources: Sequence[Source],
+    jobs: int = 1,
+    force: bool = False,
+    profile: Optional[Path] = None
+) -> Tuple[List[Scan], int]:
+    # Scans the SOURCES that changed since the last refresh into the
+    # catalog, all of them with FORCE, in a single transaction. Returns the
+    # scans and the number of sources left as they were.
+    changed = list(sources) if force else stale(connection, sources)
+    scans = []
+    with connection:
+        for scan in scan_all(changed, jobs, profile):
+            store(connection, scan)
+            scans.append(scan)
+    return scans, len(sources) - len(changed)
+
+
+def prune(connection: sqlite3.Connection) -> int:
+    # Removes the files, or archives, that no longer exist. Returns the
+    # number of files removed.
+    gone = [
+        (file_id,) for file_id, path, archive in
+        connection.execute("SELECT file_id, path, archive FROM files")
+        if not Path(archive or path).exists()
+    ]
+    with connection:
+        connection.executemany("DELETE FROM files WHERE file_id = ?", gone)
+    return len(gone)
@@ -0,0 +1,134 @@
+# Dynamic time warping between a Humdrum score and a performed midi timeline.
+# Both sides are turned into sequences of pitch-class vectors, one per onset,
+# which are aligned within a Sakoe-Chiba band around the diagonal.
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from humdrum import Chord, Note, Symbol, note_number
+
+
+def chroma(events: np.ndarray, pitches: np.ndarray, count: int) -> np.ndarray:
+    # L2-normalized pitch-class histogram of each of COUNT events, where
+    # pitches[i] sounds in events[i].
+    features = np.bincount(
+        events * 12 + pitches % 12, minlength=count * 12
+    ).reshape(count, 12).astype(np.float64)
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    return features / np.maximum(norms, 1e-9)
+
+
+def midi_features(notes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Onset clocks and their chroma vectors for a midinorm NOTE_DTYPE array.
+    clocks, events = np.unique(notes["clock"], return_inverse=True)
+    return clocks, chroma(events, notes["note"].astype(np.int64), len(clocks))
+
+
+def spine_features(
+    spines: Dict[str, List[Symbol]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Record indices holding note onsets and their chroma vectors. Symbols at
+    # the same index in all spines come from the same record, notes ending a
+    # tie are not onsets.
+    records: List[int] = []
+    pitches: List[int] = []
+    for record, symbols in enumerate(zip(*spines.values())):
+        for symbol in symbols:
+            if isinstance(symbol, Note):
+                notes = [symbol]
+            elif isinstance(symbol, Chord):
+                notes = symbol.notes
+            else:
+                continue
+            for note in notes:
+                if not note.ends_legato:
+                    records.append(record)
+                    pitches.append(note_number(note))
+    onsets, events = np.unique(
+        np.array(records, dtype=np.int64), return_inverse=True)
+    return onsets, chroma(events, np.array(pitches, dtype=np.int64), len(onsets))
+
+
+DIAGONAL, VERTICAL, HORIZONTAL = 0, 1, 2
+
+
+def dtw(
+    x: np.ndarray,
+    y: np.ndarray,
+    radius: int = 200,
+    block: int = 256
+) -> np.ndarray:
+    # Warping path between feature sequences X (n, d) and Y (m, d) as (i, j)
+    # index pairs, using the cosine distance between normalized features.
+    # Only cells within RADIUS of the diagonal are evaluated: costs are
+    # computed BLOCK rows at a time and only the step taken into each band
+    # cell is kept, so memory is linear in the length of X.
+    n, m = len(x), len(y)
+    if n == 0 or m == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    # The band must be wide enough for consecutive rows to overlap.
+    radius = max(radius, -(-m // n))
+    centers = np.arange(n) * (m - 1) // max(n - 1, 1)
+    los = np.maximum(centers - radius, 0)
+    his = np.minimum(centers + radius + 1, m)
+    steps = np.empty((n, 2 * radius + 1), dtype=np.uint8)
+
+    previous = np.empty(0)
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+        left, right = los[start], his[stop - 1]
+        costs = 1.0 - x[start:stop] @ y[left:right].T
+        for i in range(start, stop):
+            lo, hi = los[i], his[i]
+            cost = costs[i - start, lo - left:hi - left]
+            if i == 0:
+                current = np.cumsum(cost)
+                steps[0, :hi - lo] = HORIZONTAL
+                steps[0, 0] = DIAGONAL
+                previous = current
+                continue
+            # previous[] covers [los[i-1], his[i-1]), extended with infinity
+            # to cover [lo - 1, hi) for the diagonal and vertical moves.
+            plo, phi = los[i - 1], his[i - 1]
+            padded = np.full(hi - lo + 1, np.inf)
+            a, b = max(plo, lo - 1), min(phi, hi)
+            padded[a - (lo - 1):b - (lo - 1)] = previous[a - plo:b - plo]
+            diagonal, vertical = padded[:-1], padded[1:]
+            moves = np.where(diagonal <= vertical, DIAGONAL, VERTICAL)
+            entry = cost + np.minimum(diagonal, vertical)
+            # Horizontal moves chain within the row: with S the running sum
+            # of costs, D[j] = S[j] + min over k <= j of (entry[k] - S[k]).
+            sums = np.cumsum(cost)
+            relative = entry - sums
+            best = np.minimum.accumulate(relative)
+            moves[best < relative] = HORIZONTAL
+            steps[i, :hi - lo] = moves
+            previous = sums + best
+
+    path = []
+    i, j = n - 1, m - 1
+    while True:
+        path.append((i, j))
+        if i == 0 and j == 0:
+            break
+        step = steps[i, j - los[i]] if i > 0 else HORIZONTAL
+        if step == DIAGONAL:
+            i, j = i - 1, j - 1
+        elif step == VERTICAL:
+            i -= 1
+        else:
+            j -= 1
+    return np.array(path[::-1], dtype=np.int64)
+
+
+def align_spines(
+    spines: Dict[str, List[Symbol]],
+    notes: np.ndarray,
+    radius: int = 200
+) -> np.ndarray:
+    # Aligns parsed kern SPINES with a performed midinorm NOTE_DTYPE array,
+    # returns (record, clock) pairs along the warping path.
+    records, x = spine_features(spines)
+    clocks, y = midi_features(notes)
+    path = dtw(x, y, radius=radius)
+    return np.stack((records[path[:, 0]], clocks[path[:, 1]]), axis=1)
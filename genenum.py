@@ -12,4 +12,5 @@ def gen_notes():
         print("")
 
 
-gen_notes()
+if __name__ == "__main__":
+    gen_notes()
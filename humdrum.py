@@ -1,11 +1,16 @@
 # https://www.humdrum.org/guide/
 # Formal syntax: https://www.humdrum.org/guide/ch05/
+import io
 import os
 import re
 from dataclasses import dataclass
 from enum import Enum
+from fractions import Fraction
 from pathlib import Path
-from typing import Dict, List, Optional, TextIO, Union, cast
+from typing import Dict, Iterator, List, Optional, TextIO, Tuple, Union, cast
+
+import profiling
+from archive import is_archive, iter_members
 
 
 class Pitch(Enum):
@@ -74,10 +79,21 @@ class Pitch(Enum):
     bbbb = (7, 7)
 
 
+# Lookup tables, much faster than Enum construction: kern pitch names and
+# (octave, step) values to Pitch, and note names to steps.
+KERN_PITCHES: Dict[str, Pitch] = dict(Pitch.__members__)
+PITCHES: Dict[Tuple[int, int], Pitch] = {pitch.value: pitch for pitch in Pitch}
+STEPS: Dict[str, int] = {
+    name: 1 + idx for idx, name in enumerate(['c', 'd', 'e', 'f', 'g', 'a', 'b'])
+}
+
+
 def pitch_from_note_and_octave(note: str, octave: int) -> Pitch:
-    index = ['c', 'd', 'e', 'f', 'g', 'a', 'b'].index(note.lower())
-    assert index >= 0, f"Invalid note name: {note}, expected [A-Za-z]."
-    return Pitch((octave, 1+index))
+    step = STEPS.get(note.lower())
+    assert step is not None, f"Invalid note name: {note}, expected [A-Za-z]."
+    if (pitch := PITCHES.get((octave, step))) is None:
+        raise ValueError(f"Invalid octave {octave} for note {note}.")
+    return pitch
 
 
 CLEF_RE = re.compile("^\\*clef([a-zA-Z])([0-9])$")
@@ -91,6 +107,20 @@ def pitch_from_clef(clef: str) -> Pitch:
     return pitch_from_note_and_octave(name, octave)
 
 
+def recip_duration(recip: str, dots: str = "") -> Fraction:
+    # Duration in whole notes of a kern reciprocal duration with optional
+    # augmentation dots, e.g. "4." is 3/8. A recip of "0" is a breve, each
+    # additional "0" doubles it.
+    if recip.strip("0") == "":
+        duration = Fraction(2 ** len(recip))
+    else:
+        duration = Fraction(1, int(recip))
+    if dots:
+        # Each dot adds half of the previous value: 2 - 1/2^dots times.
+        duration *= 2 - Fraction(1, 2 ** len(dots))
+    return duration
+
+
 @dataclass
 class Symbol:
     pass
@@ -125,13 +155,13 @@ class Null(Symbol):
 
 @dataclass
 class Rest(Symbol):
-    duration: int
+    duration: Fraction      # In whole notes.
 
 
 @dataclass
 class Note(Symbol):
     pitch: Pitch
-    duration: int
+    duration: Fraction      # In whole notes, 0 for gracenotes.
     flats: int
     sharps: int
     starts_legato: bool
@@ -146,6 +176,16 @@ class Chord(Symbol):
     notes: List[Note]
 
 
+# Semitones above C of each step of a Pitch.
+STEP_SEMITONES = (0, 2, 4, 5, 7, 9, 11)
+
+
+def note_number(note: Note) -> int:
+    # Midi note number of NOTE, middle C (Pitch.c) being 60.
+    octave, step = note.pitch.value
+    return 12 * (octave + 1) + STEP_SEMITONES[step - 1] + note.sharps - note.flats
+
+
 class HumdrumParser:
 
     path: Union[str, Path]
@@ -153,13 +193,20 @@ class HumdrumParser:
     lineno: int = 0
     verbose: bool = False
 
-    spines: Dict[str, List[Symbol]] = {}
-
-    def __init__(self, path: Union[str, Path]):
-        if not Path(path).exists():
-            raise FileNotFoundError(f"Can't open file {path}")
-        self.path = path
-        self.file = open(self.path, 'r')
+    spines: Dict[str, List[Symbol]]
+
+    def __init__(self, source: Union[str, Path, TextIO]):
+        # SOURCE is either a path or an already opened text stream, e.g. of
+        # an archive member.
+        self.spines = {}
+        if isinstance(source, (str, Path)):
+            if not Path(source).exists():
+                raise FileNotFoundError(f"Can't open file {source}")
+            self.path = source
+            self.file = open(self.path, 'r')
+        else:
+            self.path = getattr(source, "name", "<stream>")
+            self.file = source
 
     def error(self, msg: str):
         raise ValueError(f"{self.path}, {self.lineno}: {msg}")
@@ -168,7 +215,9 @@ class HumdrumParser:
 
     def next(self, throw_on_end: bool = False) -> Optional[str]:
         while True:
-            line = self.file.readline().strip()
+            # Only at the end does readline() return a line without newline.
+            line = self.file.readline()
+            line = line.strip() if line else None
             self.lineno += 1
             if line is None:
                 if throw_on_end:
@@ -180,30 +229,30 @@ class HumdrumParser:
         symbol = self.next()
         assert not symbol, f"Unexpected symbol '{symbol}' after spine end."
 
-    NOTE_RE = re.compile("^([\\d]+)?(\\.*)?([a-gA-G]+)(.*)$")
+    # Ties, slurs and phrases open before the duration.
+    NOTE_RE = re.compile("^[\\[({&]*([\\d]+)?(\\.*)?([a-gA-G]+)(.*)$")
 
     def parse_note(self, token) -> Note:
         if not (m := self.NOTE_RE.match(token)):
             self.error(f"Invalid duration or note in token '{token}'")
         additional = m.group(4)
         # Checks for a valid pitch:
-        if m.group(3) not in Pitch.__members__:
+        if (pitch := KERN_PITCHES.get(m.group(3))) is None:
             self.error(f"Unknown pitch '{m.group(3)}'.")
         # Computes duration with optional dots
-        duration = -1
+        duration = Fraction(0)
         if m.group(1):
-            duration = int(m.group(1))
-            if (dots := m.group(2)):
-                duration += len(dots)   # TODO Fix this duration computation
+            duration = recip_duration(m.group(1), m.group(2))
         else:
             assert "q" in additional, "Gracenotes expected without duration."
         return Note(
-            pitch=Pitch[m.group(3)],
+            pitch=cast(Pitch, pitch),
             duration=duration,
-            flats=token.count("#"),
-            sharps=token.count("-"),
-            starts_legato="[" in token,
-            ends_legato="]" in token,
+            flats=token.count("-"),
+            sharps=token.count("#"),
+            # A middle tie (_) both ends the previous tie and starts the next.
+            starts_legato="[" in token or "_" in token,
+            ends_legato="]" in token or "_" in token,
             starts_beam="J" in token,
             ends_beam="L" in token,
             is_gracenote="q" in token,
@@ -220,7 +269,7 @@ class HumdrumParser:
         elif symbol.startswith("!"):
             pass
         elif (m := self.REST_RE.match(symbol)):
-            spine.append(Rest(int(m.group(1))))
+            spine.append(Rest(recip_duration(m.group(1), m.group(2))))
         else:
             notes = list([])
             for note in symbol.split():
@@ -235,6 +284,7 @@ class HumdrumParser:
     METER_RE = re.compile("^\\*M(\\d)/(\\d)$")
     METRICAL_RE = re.compile("^\\*met\\((C\\|?)\\)$")
 
+    @profiling.timed("kern.parse")
     def parse(self):
         self.header()
         while True:
@@ -262,6 +312,11 @@ class HumdrumParser:
                         spine.append(Meter(2, 2))
                 elif (symbol == '*-'):
                     self.end()
+                    if profiling.ENABLED:
+                        profiling.count("kern.files")
+                        profiling.count("kern.lines", self.lineno)
+                        profiling.count("kern.symbols", sum(
+                            len(spine) for spine in self.spines.values()))
                     return
                 else:
                     self.parse_event(spine, symbol)
@@ -278,21 +333,39 @@ DATADIR = Path(
     "/home/anselm/Downloads/GrandPiano/chopin/preludes")
 
 
-def parse_all():
-    parsed, failed = 0, 0
-    for root, _, filenames in os.walk(DATADIR):
+def kern_files(root: Path) -> Iterator[Tuple[str, Union[Path, TextIO]]]:
+    # The name and path, or text stream for archive members, of each kern
+    # file under directory ROOT or within archive ROOT.
+    if is_archive(root):
+        for member, data in iter_members(root, ('.krn',)):
+            stream = io.StringIO(data.decode())
+            stream.name = str(member)
+            yield str(member), stream
+        return
+    for dirpath, _, filenames in os.walk(root):
         for filename in filenames:
-            path = Path(root) / filename
+            path = Path(dirpath) / filename
             # if filename.name == "min3_down_m-0-4.krn":
             if path.suffix == '.krn':
-                try:
-                    parsed += 1
-                    h = HumdrumParser(path)
-                    h.parse()
-                except Exception as e:
-                    failed += 1
-                    print(f"{path.name}: {e}")
+                yield path.name, path
+
+
+def parse_all(root: Path = DATADIR):
+    parsed, failed = 0, 0
+    for name, source in kern_files(root):
+        try:
+            parsed += 1
+            h = HumdrumParser(source)
+            h.parse()
+        except Exception as e:
+            failed += 1
+            print(f"{name}: {e}")
     print(f"Parsed {parsed} files, {failed} failed.")
 
 
-parse_all()
+def main():
+    parse_all()
+
+
+if __name__ == "__main__":
+    main()
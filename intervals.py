@@ -0,0 +1,166 @@
+# Static centered interval tree over note intervals [start, end), to find the
+# notes sounding during a window rather than only those starting in it. The
+# tree is built level by level and stored in flat arrays, so that building
+# and batches of queries run as a few numpy operations per tree level.
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import numpy as np
+
+
+@dataclass
+class IntervalTree:
+    # Per node: its center and the left and right children (-1 for none).
+    centers: np.ndarray
+    lefts: np.ndarray
+    rights: np.ndarray
+    # Each node holds the intervals containing its center, as a segment
+    # [bounds[node], bounds[node + 1]) of BY_START, the interval indices
+    # sorted by node then start, and of BY_END, sorted by node then
+    # descending end. The keys sort alike and combine node and start (resp.
+    # end) into a single int64, so that all nodes are searched at once.
+    bounds: np.ndarray
+    by_start: np.ndarray
+    start_keys: np.ndarray
+    by_end: np.ndarray
+    end_keys: np.ndarray
+    lo: int
+    hi: int
+
+    @property
+    def span(self) -> int:
+        return self.hi - self.lo + 2
+
+    def query(self, start: int, end: int) -> np.ndarray:
+        # Sorted indices of the intervals overlapping [start, end).
+        return self.query_batch(np.array([start]), np.array([end]))[1]
+
+    def at(self, ticks: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # The intervals containing each of TICKS, see query_batch.
+        ticks = np.asarray(ticks, dtype=np.int64)
+        return self.query_batch(ticks, ticks + 1)
+
+    def query_batch(
+        self,
+        starts: np.ndarray,
+        ends: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # The intervals overlapping each window [starts[i], ends[i]), in CSR
+        # form: the sorted indices of window i are
+        # indices[offsets[i]:offsets[i + 1]].
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        # Clipping keeps the keys within their node's range.
+        lows = np.clip(starts, self.lo - 1, self.hi)
+        highs = np.clip(ends, self.lo, self.hi + 1)
+        span = self.span
+        windows = np.nonzero(ends > starts)[0]
+        if len(self.centers) == 0:
+            windows = windows[:0]
+        nodes = np.zeros(len(windows), dtype=np.int64)
+        found_windows, found = [], []
+        while windows.size:
+            centers = self.centers[nodes]
+            first = self.bounds[nodes]
+            # Windows left of the center overlap the node's intervals
+            # starting before they end, windows right of it the intervals
+            # ending after they start, and windows around it all of them.
+            left = highs[windows] <= centers
+            right = lows[windows] >= centers
+            last = self.bounds[nodes + 1]
+            last[left] = np.searchsorted(
+                self.start_keys,
+                nodes[left] * span + highs[windows[left]] - self.lo)
+            last[right] = np.searchsorted(
+                self.end_keys,
+                nodes[right] * span + self.hi - lows[windows[right]])
+            for mask, order in ((~right, self.by_start), (right, self.by_end)):
+                owners, positions = ranges(first[mask], last[mask])
+                found_windows.append(windows[mask][owners])
+                found.append(order[positions])
+            # Descends into the children that may overlap.
+            go_left, go_right = ~right, ~left
+            windows = np.concatenate((windows[go_left], windows[go_right]))
+            nodes = np.concatenate((self.lefts[nodes[go_left]],
+                                    self.rights[nodes[go_right]]))
+            keep = nodes >= 0
+            windows, nodes = windows[keep], nodes[keep]
+        found_windows = np.concatenate(found_windows + [np.empty(0, np.int64)])
+        found = np.concatenate(found + [np.empty(0, np.int64)])
+        # Sorts by window then index with a single combined key.
+        order = np.argsort(found_windows * len(self.by_start) + found)
+        counts = np.bincount(found_windows, minlength=len(starts))
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return offsets, found[order]
+
+
+def ranges(first: np.ndarray, last: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Owner and position of every element of the ranges [first, last).
+    lengths = np.maximum(last - first, 0)
+    total = int(lengths.sum())
+    owners = np.repeat(np.arange(len(first)), lengths)
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return owners, first[owners] + offsets
+
+
+def concat(parts: List[np.ndarray]) -> np.ndarray:
+    return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+
+def build_tree(starts: np.ndarray, ends: np.ndarray) -> IntervalTree:
+    # Intervals are half open, empty ones are extended to a single tick.
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.maximum(np.asarray(ends, dtype=np.int64), starts + 1)
+    count = len(starts)
+    holders = np.empty(count, dtype=np.int64)
+    centers, lefts, rights = [], [], []
+    # Intervals still to place, and the node they belong to in the current
+    # level, numbered from BASE.
+    active = np.arange(count)
+    nodes = np.zeros(count, dtype=np.int64)
+    base, width = 0, 1 if count else 0
+    while active.size:
+        order = np.lexsort((starts[active], nodes))
+        active, nodes = active[order], nodes[order]
+        sizes = np.bincount(nodes, minlength=width)
+        # The median start of each node, its interval contains the center.
+        center = starts[active[np.cumsum(sizes) - sizes + sizes // 2]]
+        s, e, c = starts[active], ends[active], center[nodes]
+        left, right = e <= c, s > c
+        here = ~(left | right)
+        holders[active[here]] = base + nodes[here]
+        has_left = np.bincount(nodes[left], minlength=width) > 0
+        has_right = np.bincount(nodes[right], minlength=width) > 0
+        left_ids = np.cumsum(has_left) - 1
+        right_ids = int(has_left.sum()) + np.cumsum(has_right) - 1
+        top = base + width
+        centers.append(center)
+        lefts.append(np.where(has_left, top + left_ids, -1))
+        rights.append(np.where(has_right, top + right_ids, -1))
+        nodes = np.where(left, left_ids[nodes], right_ids[nodes])[~here]
+        active = active[~here]
+        base, width = top, int(has_left.sum() + has_right.sum())
+    lo = int(starts.min()) if count else 0
+    hi = int(ends.max()) if count else 0
+    span = hi - lo + 2
+    by_start = np.lexsort((starts, holders))
+    by_end = np.lexsort((-ends, holders))
+    centers = concat(centers)
+    return IntervalTree(
+        centers=centers,
+        lefts=concat(lefts),
+        rights=concat(rights),
+        bounds=np.searchsorted(holders[by_start], np.arange(len(centers) + 1)),
+        by_start=by_start,
+        start_keys=holders[by_start] * span + starts[by_start] - lo,
+        by_end=by_end,
+        end_keys=holders[by_end] * span + hi - ends[by_end],
+        lo=lo,
+        hi=hi,
+    )
+
+
+def note_tree(notes: np.ndarray) -> IntervalTree:
+    # Tree of the notes of a timeline, see midinorm.NOTE_DTYPE. Queries
+    # return indices into NOTES.
+    return build_tree(notes["clock"], notes["clock"] + notes["duration"])
@@ -0,0 +1,85 @@
+# Renders the spines of a parsed kern file (see humdrum) into a midi file.
+from fractions import Fraction
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from humdrum import Chord, Meter, Note, Rest, Symbol, note_number
+from midi.output import MidiOutput
+from midi.typing import Velocity
+
+
+def render_spine(
+    spine: List[Symbol],
+    divisions: int = 480
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Returns the clocks, durations and note numbers of the notes played by
+    # SPINE, in ticks at DIVISIONS per quarter note. Tied notes are merged
+    # and gracenotes dropped. Time is kept as an exact fraction of a whole
+    # note and only rounded to ticks once.
+    clock = Fraction(0)
+    starts: List[Fraction] = []
+    lengths: List[Fraction] = []
+    pitches: List[int] = []
+    ties: Dict[int, int] = {}
+    for symbol in spine:
+        if isinstance(symbol, Rest):
+            clock += symbol.duration
+            continue
+        elif isinstance(symbol, Note):
+            notes = [symbol]
+        elif isinstance(symbol, Chord):
+            notes = symbol.notes
+        else:
+            continue
+        step: Optional[Fraction] = None
+        for note in notes:
+            if note.is_gracenote:
+                continue
+            number = note_number(note)
+            if note.ends_legato and number in ties:
+                lengths[ties[number]] += note.duration
+                if not note.starts_legato:
+                    del ties[number]
+            else:
+                if note.starts_legato:
+                    ties[number] = len(pitches)
+                starts.append(clock)
+                lengths.append(note.duration)
+                pitches.append(number)
+            step = note.duration if step is None else min(step, note.duration)
+        clock += step or 0
+    ticks = 4 * divisions
+    return (
+        np.array([round(start * ticks) for start in starts], dtype=np.int64),
+        np.array([round(length * ticks) for length in lengths], dtype=np.int64),
+        np.array(pitches, dtype=np.int64),
+    )
+
+
+def render(
+    spines: Dict[str, List[Symbol]],
+    divisions: int = 480,
+    bpm: int = 120,
+    velocity: Velocity = Velocity.Standard
+) -> MidiOutput:
+    # Renders all SPINES in a format 0 midi file, each spine on its own
+    # channel.
+    rendered = [render_spine(spine, divisions) for spine in spines.values()]
+    clocks = np.concatenate([r[0] for r in rendered] + [np.empty(0, np.int64)])
+    durations = np.concatenate(
+        [r[1] for r in rendered] + [np.empty(0, np.int64)])
+    notes = np.concatenate([r[2] for r in rendered] + [np.empty(0, np.int64)])
+    channels = np.concatenate(
+        [np.full(len(r[0]), idx % 16, dtype=np.int64)
+         for idx, r in enumerate(rendered)] + [np.empty(0, np.int64)])
+    meter = next((symbol for spine in spines.values()
+                 for symbol in spine if isinstance(symbol, Meter)), None)
+    signature = (None if meter is None
+                 else (meter.numerator, meter.denominator))
+    output = MidiOutput()
+    output.write_format0(
+        clocks.tolist(), durations.tolist(), notes.tolist(), channels.tolist(),
+        [velocity.value] * len(notes), divisions, bpm, signature,
+    )
+    return output
@@ -0,0 +1,156 @@
+# Manifest of the inputs processed into a cache directory, so that batch runs
+# only redo the work whose inputs, parameters or code changed. Each entry
+# records an input's size, modification time and content hash, along with
+# the version of each stage that produced its outputs.
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
+
+from archive import Member, Reader, Source, digest
+
+MANIFEST = "manifest.json"
+
+# Version of the outputs of each stage: bump it whenever a change to the code
+# changes what the stage produces, so that its outputs get recomputed.
+STAGES: Dict[str, int] = {
+    "midi-decode": 1,
+    "midi-normalize": 1,
+    "kern-parse": 2,
+    "kern-tokenize": 1,
+    "rasterize": 1,
+    "deskew": 1,
+    "staff-detect": 1,
+    "cut": 1,
+    "align": 1,
+    "melody-shingle": 2,
+}
+
+
+@dataclass
+class Entry:
+    size: int
+    mtime: int                  # In nanoseconds.
+    digest: Optional[str]       # None when the task didn't read the input.
+    stages: Dict[str, int]
+    params: dict
+    # Size and modification time of other files the outputs derive from,
+    # e.g. the outputs of earlier stages.
+    depends: Dict[str, Tuple[int, int]] = field(default_factory=dict)
+
+
+def key(source: Source) -> str:
+    if isinstance(source, Member):
+        return f"{source.archive.resolve()}:{source.name}"
+    return str(source.resolve())
+
+
+def cache_path(cache_dir: Path, source: Source, suffix: str) -> Path:
+    # Output of SOURCE in CACHE_DIR, named after its stem made unique by a
+    # hash of its full path, so that same-named inputs of different
+    # directories or archives don't overwrite each other's outputs. The hash
+    # leaves out the suffix: a pdf and a midi file of the same name in the
+    # same directory share the names of their outputs, see omr align.
+    path = key(source)
+    path = path[:len(path) - len(source.suffix)]
+    return Path(cache_dir) / f"{source.stem}-{digest(path.encode())[:12]}{suffix}"
+
+
+def stat(source: Source | Path) -> Tuple[int, int]:
+    # Size and modification time of SOURCE, (-1, -1) when it doesn't exist.
+    if isinstance(source, Member):
+        return source.size, source.mtime
+    try:
+        result = os.stat(source)
+    except FileNotFoundError:
+        return -1, -1
+    return result.st_size, result.st_mtime_ns
+
+
+def stage_versions(stages: Sequence[str]) -> Dict[str, int]:
+    return {stage: STAGES[stage] for stage in stages}
+
+
+class Manifest:
+    # Entries per command, then per input.
+
+    path: Path
+    commands: Dict[str, Dict[str, Entry]]
+
+    def __init__(self, cache_dir: Path):
+        self.path = Path(cache_dir) / MANIFEST
+        self.commands = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                data = json.load(f)
+            self.commands = {
+                command: {
+                    name: Entry(**{**entry, "depends": {
+                        path: tuple(value)
+                        for path, value in entry.get("depends", {}).items()
+                    }})
+                    for name, entry in entries.items()
+                }
+                for command, entries in data.get("commands", {}).items()
+            }
+
+    def fresh(
+        self,
+        command: str,
+        source: Source,
+        stages: Dict[str, int],
+        params: dict,
+        depends: Sequence[Path],
+        reader: Reader
+    ) -> bool:
+        # Whether the outputs of COMMAND for SOURCE are up to date. A source
+        # whose modification time changed but whose content didn't is
+        # refreshed in place rather than reprocessed.
+        entry = self.commands.get(command, {}).get(key(source))
+        if (entry is None or entry.stages != stages or entry.params != params or
+                entry.depends != {str(path): stat(path) for path in depends}):
+            return False
+        size, mtime = stat(source)
+        if (size, mtime) == (entry.size, entry.mtime):
+            return True
+        if size != entry.size or entry.digest is None:
+            return False
+        if digest(reader.read_raw(source)) != entry.digest:
+            return False
+        entry.mtime = mtime
+        return True
+
+    def record(
+        self,
+        command: str,
+        source: Source,
+        stages: Dict[str, int],
+        params: dict,
+        depends: Sequence[Path],
+        content: Optional[str]
+    ):
+        size, mtime = stat(source)
+        self.commands.setdefault(command, {})[key(source)] = Entry(
+            size=size,
+            mtime=mtime,
+            digest=content,
+            stages=stages,
+            params=params,
+            depends={str(path): stat(path) for path in depends},
+        )
+
+    def forget(self, command: str, source: Source):
+        self.commands.get(command, {}).pop(key(source), None)
+
+    def save(self):
+        # Written aside then renamed, so that an interrupted run leaves the
+        # previous manifest intact.
+        temp = self.path.with_suffix(".tmp")
+        with open(temp, "w") as f:
+            json.dump(dict(commands={
+                command: {name: asdict(entry) for name, entry in entries.items()}
+                for command, entries in self.commands.items()
+            }), f, indent=1)
+            f.write("\n")
+        os.replace(temp, self.path)
@@ -0,0 +1,152 @@
+# Bar index of a midi file: where each bar starts in each track chunk, along
+# with the decoder state at that point, so that a range of bars can be
+# decoded without the events before it (see MidiInput.parse_range).
+import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from midi.input import TrackScanner
+from midi.typing import EventType
+
+
+def bar_clocks(
+    signatures: List[Tuple[int, int, int]],
+    divisions: int,
+    end: int
+) -> np.ndarray:
+    # Start clock of each bar given time signatures as (clock, nn, dd) tuples,
+    # followed by the clock at which the bar containing END ends. A bar
+    # starts at every time signature change.
+    signatures = sorted(signatures)
+    if not signatures or signatures[0][0] > 0:
+        signatures.insert(0, (0, 4, 2))
+    starts = []
+    for idx, (clock, nn, dd) in enumerate(signatures):
+        length = max(1, (4 * divisions * nn) // (2 ** dd))
+        if idx + 1 < len(signatures):
+            stop = signatures[idx + 1][0]
+        else:
+            stop = max(end, clock) + length
+        starts.append(np.arange(clock, stop, length, dtype=np.int64))
+    return np.concatenate(starts)
+
+
+@dataclass
+class BarIndex:
+    header: int             # Offset of the MThd chunk.
+    divisions: int
+    signatures: np.ndarray  # (count, 3) time signatures as (tick, nn, dd).
+    bars: np.ndarray        # Bar start ticks, as from bar_clocks.
+    # For each track and bar, the offset in the file of the first event at
+    # or after the bar start, the running status before it (0 for none)
+    # and the tick it is relative to, i.e. the tick of the event before it.
+    # A last column holds the end of each track chunk.
+    offsets: np.ndarray     # (tracks, bars + 1) int64
+    statuses: np.ndarray    # (tracks, bars + 1) uint8
+    ticks: np.ndarray       # (tracks, bars + 1) int64
+
+
+class BarScanner(TrackScanner):
+    # Records the offset, running status before and tick of each event, and
+    # the time signatures.
+
+    offsets: array.array
+    statuses: array.array
+    ticks: array.array
+    signatures: List[Tuple[int, int, int]]
+
+    def scan_track(
+        self,
+        start: int,
+        length: int,
+        signatures: List[Tuple[int, int, int]]
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Returns the offset, running status before and tick of each event of
+        # the track chunk at START, appending its time signatures.
+        self.offsets, self.statuses, self.ticks = (
+            array.array("q"), array.array("B"), array.array("q"))
+        self.signatures = signatures
+        self.walk_track(start, length)
+        return (np.frombuffer(self.offsets, dtype=np.int64),
+                np.frombuffer(self.statuses, dtype=np.uint8),
+                np.frombuffer(self.ticks, dtype=np.int64))
+
+    def event(self, pos: int, status: int, tick: int):
+        self.offsets.append(pos)
+        self.statuses.append(status)
+        self.ticks.append(tick)
+
+    def meta(self, tick: int, meta_type: int, size: int):
+        if meta_type == EventType.TimeSignature.code():
+            self.signatures.append((tick, self.buf[self.pos],
+                                    self.buf[self.pos + 1]))
+
+
+def build_index(buf: array.array) -> BarIndex:
+    scanner = BarScanner(buf)
+    header, tracks = scanner.scan_chunks()
+    # Divisions follow the format and number of tracks in MThd.
+    scanner.pos = header + 12
+    divisions = scanner.read_u16()
+    signatures: List[Tuple[int, int, int]] = []
+    events = [scanner.scan_track(start, length, signatures)
+              for start, length in tracks]
+    end = max((int(ticks[-1]) for _, _, ticks in events if len(ticks)),
+              default=0)
+    bars = bar_clocks(signatures, divisions, end)
+    shape = (len(tracks), len(bars) + 1)
+    offsets = np.empty(shape, dtype=np.int64)
+    statuses = np.zeros(shape, dtype=np.uint8)
+    ticks = np.empty(shape, dtype=np.int64)
+    for track, ((start, length), (offs, stats, tks)) in enumerate(
+            zip(tracks, events)):
+        # The first event of each bar, past the end when there is none.
+        first = np.searchsorted(tks, bars, side="left")
+        inside = first < len(tks)
+        offsets[track, :-1] = start + length
+        offsets[track, :-1][inside] = offs[first[inside]]
+        offsets[track, -1] = start + length
+        statuses[track, :-1][inside] = stats[first[inside]]
+        # The tick an event is relative to is the one of the event before.
+        before = np.concatenate(([0], tks))
+        ticks[track, :-1] = before[first]
+        ticks[track, -1] = before[-1]
+    return BarIndex(
+        header=header,
+        divisions=divisions,
+        signatures=np.array(sorted(signatures),
+                            dtype=np.int64).reshape(-1, 3),
+        bars=bars,
+        offsets=offsets,
+        statuses=statuses,
+        ticks=ticks,
+    )
+
+
+def save_index(target: Path | str, index: BarIndex):
+    np.savez(
+        target,
+        header=index.header,
+        divisions=index.divisions,
+        signatures=index.signatures,
+        bars=index.bars,
+        offsets=index.offsets,
+        statuses=index.statuses,
+        ticks=index.ticks,
+    )
+
+
+def load_index(source: Path | str) -> BarIndex:
+    with np.load(source) as data:
+        return BarIndex(
+            header=int(data["header"]),
+            divisions=int(data["divisions"]),
+            signatures=data["signatures"],
+            bars=data["bars"],
+            offsets=data["offsets"],
+            statuses=data["statuses"],
+            ticks=data["ticks"],
+        )
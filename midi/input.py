@@ -1,9 +1,23 @@
 import array
 from abc import ABC, abstractmethod
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import (
+    TYPE_CHECKING,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    cast,
+)
 
+import profiling
 from midi.typing import (
-    Channel,
+    CHANNELS,
+    INSTRUMENTS,
+    NOTES,
     CloseTrackEvent,
     ControlChangeEvent,
     DataEvent,
@@ -11,11 +25,9 @@ from midi.typing import (
     EventType,
     Format,
     HeaderDataEvent,
-    Instrument,
     KeySignatureEvent,
     NoteOffEvent,
     NoteOnEvent,
-    Notes,
     OpenTrackEvent,
     ProgramChangeEvent,
     SequenceNumberEvent,
@@ -24,14 +36,77 @@ from midi.typing import (
     TimeSignatureEvent,
 )
 
+if TYPE_CHECKING:
+    from midi.index import BarIndex
+
+
+# Event types by their meta type and channel message type codes.
+META_TYPES = {
+    event_type.code(): event_type for event_type in EventType
+    if isinstance(event_type.value, tuple) and
+    event_type.value[0] == EventType.Meta.value
+}
+CHANNEL_TYPES = {
+    event_type.code(): event_type for event_type in (
+        EventType.NoteOff, EventType.NoteOn,
+        EventType.ControlChange, EventType.ProgramChange,
+    )
+}
+# Event types handled past the end of a range, see parse_range. NoteOn is
+# how most files send NoteOff, with a zero velocity.
+NOTE_OFFS = frozenset({EventType.NoteOn, EventType.NoteOff})
+# Data bytes following the status of each channel message type, including
+# the ones we don't decode (aftertouch, channel pressure and pitch bend).
+CHANNEL_LENGTHS = {
+    0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2,
+}
+
+
+class TrackMerger(ABC):
+    # Mixin of the MidiInput parsers that parse_parallel can run a track at a
+    # time in worker processes. Their constructor takes the buffer alone.
+
+    @abstractmethod
+    def track_result(self) -> object:
+        # What the parser gathered from the single track it handled.
+        pass
+
+    @abstractmethod
+    def merge_track(self, result: object):
+        # Adds the RESULT of a track, as from track_result, as if this parser
+        # had handled the track's events.
+        pass
+
 
 class MidiInput(ABC):
 
     buf: array.array
     pos: int = 0
+    # Event types passed to handle, all when None. The others are skipped by
+    # length without being decoded, their delta times being carried over to
+    # the next handled event. Synthetic events are always handled.
+    wanted: Optional[FrozenSet[EventType]] = None
+    skipped_dt: int = 0
+    # Set by parse_range past the end of the range, where only note offs are
+    # handled, NoteOn events with a velocity being skipped too.
+    note_offs_only: bool = False
 
-    def __init__(self, buf: array.array):
+    def __init__(
+        self,
+        buf: array.array,
+        wanted: Optional[Iterable[EventType]] = None
+    ):
         self.buf = buf
+        if wanted is not None:
+            wanted = set(wanted)
+            # NoteOn with a zero velocity is how most files send NoteOff.
+            if EventType.NoteOff in wanted:
+                wanted.add(EventType.NoteOn)
+            self.wanted = frozenset(wanted)
+
+    def skip_event(self, dt: int, length: int):
+        self.skip(length)
+        self.skipped_dt = dt
 
     def debug(self, start_off: int = 5, end_off: int = 5):
         start = max(0, self.pos - start_off)
@@ -39,6 +114,7 @@ class MidiInput(ABC):
         print(''.join([f"{
             hex(self.buf[pos])} " for pos in range(start, end)]))
 
+    @profiling.timed("midi.parse")
     def parse(self):
         self.decode_header()
 
@@ -95,7 +171,6 @@ class MidiInput(ABC):
                 self.parse_mtrk()
             else:
                 raise ValueError(f"Invalid chunk type {chunk_type}")
-        print(f"{chunk_type}")
 
     def parse_mthd(self):
         length = self.read_u32()
@@ -107,7 +182,11 @@ class MidiInput(ABC):
 
     def parse_meta_event(self, dt: int):
         meta_type = self.next()
-        if meta_type == EventType.SequenceNumber.code():
+        if (self.wanted is not None and
+                meta_type != EventType.EndTrack.code() and
+                META_TYPES.get(meta_type) not in self.wanted):
+            self.skip_event(dt, self.read_varlen())
+        elif meta_type == EventType.SequenceNumber.code():
             assert self.next() == 2, "Expecting sequence number meta-event of length 2."
             sequence_number = self.next()
             self.handle(SequenceNumberEvent(dt, sequence_number))
@@ -156,44 +235,54 @@ class MidiInput(ABC):
 
     def parse_channel_message(self, dt: int, event_type: int):
         self.last_status = None
-        channel = (event_type & 0x7)
+        channel = (event_type & 0x0F)
         message_type = (event_type & 0xF0)
-        if message_type == EventType.ProgramChange.code():
+        if (self.wanted is not None and
+                CHANNEL_TYPES.get(message_type) not in self.wanted):
+            self.last_status = event_type
+            self.skip_event(dt, CHANNEL_LENGTHS[message_type])
+        elif message_type == EventType.ProgramChange.code():
             # Channel program change, supports running status.
-            channel = (event_type & 0x7)
+            self.last_status = event_type
+            channel = (event_type & 0x0F)
             program = self.next() & 0x7F
             self.handle(ProgramChangeEvent(
-                dt, Channel(channel), Instrument(program)))
+                dt, CHANNELS[channel], INSTRUMENTS[program]))
         elif (event_type & 0xF0) == EventType.NoteOn.code():
             # Note on event, supports running status.
             self.last_status = event_type
-            channel = (event_type & 0x7)
+            channel = (event_type & 0x0F)
             key = self.next()
             vel = self.next()
             # Converts 0-velocity NoteOn into NoteOff.
+            if ((vel == 0 and self.wanted is not None and
+                    EventType.NoteOff not in self.wanted) or
+                    (vel > 0 and self.note_offs_only)):
+                self.skipped_dt = dt
+                return
             self.handle(
                 NoteOnEvent(
                     dt,
-                    Channel(channel),
-                    Notes(key), vel) if vel > 0 else NoteOffEvent
-                (dt, Channel(channel), Notes(key), vel))
+                    CHANNELS[channel],
+                    NOTES[key], vel) if vel > 0 else NoteOffEvent
+                (dt, CHANNELS[channel], NOTES[key], vel))
         elif (event_type & 0xF0) == EventType.NoteOff.code():
             # Note on event, supports running status.
             self.last_status = event_type
-            channel = (event_type & 0x7)
+            channel = (event_type & 0x0F)
             key = self.next()
             vel = self.next()
-            self.handle(NoteOffEvent(dt, Channel(channel), Notes(key), vel))
+            self.handle(NoteOffEvent(dt, CHANNELS[channel], NOTES[key], vel))
         elif (event_type & 0xF0) == EventType.ControlChange.code():
             self.last_status = event_type
             # Todo this includes pedal settings (controller number 64 or 91)
-            channel = (event_type & 0x07)
+            channel = (event_type & 0x0F)
             controller_number = self.next()
             value = self.next()
             self.handle(ControlChangeEvent(
-                dt, Channel(channel), controller_number, value))
+                dt, CHANNELS[channel], controller_number, value))
         else:
-            raise ValueError(f"[{Channel(channel).name}] Unknown channel message type {
+            raise ValueError(f"[{CHANNELS[channel].name}] Unknown channel message type {
                 hex(message_type)}.")
 
     def parse_running_status(self, dt: int) -> bool:
@@ -204,11 +293,16 @@ class MidiInput(ABC):
         return False
 
     def parse_event(self):
-        dt = self.read_varlen()
+        dt = self.read_varlen() + self.skipped_dt
+        self.skipped_dt = 0
         event_type = self.next()
         if EventType.is_sysex_code(event_type):
             # System exclusive message.
             length = self.read_varlen()
+            if (self.wanted is not None and
+                    EventType(event_type) not in self.wanted):
+                self.skip_event(dt, length)
+                return
             self.handle(DataEvent(
                 dt, EventType(event_type),
                 data=self.buf[self.pos:self.pos+length]
@@ -222,13 +316,177 @@ class MidiInput(ABC):
             raise ValueError(f"Unknown event type {hex(event_type)}")
 
     def parse_mtrk(self):
+        # Running status doesn't carry over from one track to the next.
+        self.last_status = None
+        self.skipped_dt = 0
         self.handle(OpenTrackEvent())
         length = self.read_u32()
         start = self.pos
+        events = 0
         while (self.pos - start < length):
             self.parse_event()
+            events += 1
+        if profiling.ENABLED:
+            profiling.count("midi.tracks")
+            profiling.count("midi.events", events)
+            profiling.count("midi.bytes", length + 8)
         self.handle(CloseTrackEvent())
 
+    def scan_chunks(self) -> Tuple[int, List[Tuple[int, int]]]:
+        # Walks the chunk headers only, returning the offset of the MThd chunk
+        # and the (offset, length) of the data of each MTrk chunk.
+        header, tracks, pos = -1, [], 0
+        while pos + 8 <= len(self.buf):
+            chunk_type = self.buf[pos:pos + 4].tobytes()
+            length = int.from_bytes(self.buf[pos + 4:pos + 8], "big")
+            if chunk_type == b"MThd":
+                header = pos
+            elif chunk_type == b"MTrk":
+                tracks.append((pos + 8, length))
+            else:
+                raise ValueError(f"Invalid chunk type {chunk_type!r}")
+            pos += 8 + length
+        if header < 0:
+            raise ValueError("No MThd chunk.")
+        return header, tracks
+
+    @profiling.timed("midi.parse")
+    def parse_parallel(self, jobs: Optional[int] = None):
+        # Same as parse for files of several tracks, parsing them in JOBS
+        # processes. Each track is handled by a parser of the same class in
+        # the worker, see parse_track, and what it gathered is merged into
+        # this one with merge_track, track after track. Parsers that aren't
+        # TrackMergers parse sequentially.
+        header, tracks = self.scan_chunks()
+        if (jobs == 1 or len(tracks) < 2 or
+                not isinstance(self, TrackMerger)):
+            return self.decode_header()
+        self.pos = header + 4
+        self.parse_mthd()
+        self.pos = len(self.buf)
+        mthd = self.buf[header:header + 14].tobytes()
+        chunks = [mthd + self.buf[start:start + length].tobytes()
+                  for start, length in tracks]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for (_, length), (events, result) in zip(tracks, pool.map(
+                    parse_track, repeat(type(self)), chunks)):
+                self.merge_track(result)
+                if profiling.ENABLED:
+                    profiling.count("midi.tracks")
+                    profiling.count("midi.events", events)
+                    profiling.count("midi.bytes", length + 8)
+
+    @profiling.timed("midi.parse_range")
+    def parse_range(self, index: "BarIndex", first: int, last: Optional[int] = None):
+        # Decodes the events of bars [FIRST, LAST) only, all the remaining
+        # bars when LAST is None, seeking into each track with INDEX (see
+        # midi.index). Clocks stay absolute, the first event of each track
+        # getting the tick it follows as additional delta time. Past LAST,
+        # the note offs of each track are handled for as long as pending()
+        # is true, so that notes sounding at the end of the range get their
+        # duration.
+        count = index.offsets.shape[1] - 1
+        last = count if last is None else last
+        if not 0 <= first <= last <= count:
+            raise ValueError(f"Invalid bar range [{first}, {last}), "
+                             f"expected within [0, {count}].")
+        self.pos = index.header + 4
+        self.parse_mthd()
+        wanted = self.wanted
+        for track in range(len(index.offsets)):
+            self.handle(OpenTrackEvent())
+            self.pos = int(index.offsets[track, first])
+            self.last_status = int(index.statuses[track, first]) or None
+            self.skipped_dt = int(index.ticks[track, first])
+            stop = int(index.offsets[track, last])
+            while self.pos < stop:
+                self.parse_event()
+            end = int(index.offsets[track, -1])
+            self.wanted = NOTE_OFFS
+            self.note_offs_only = True
+            try:
+                while self.pos < end and self.pending():
+                    self.parse_event()
+            finally:
+                self.wanted = wanted
+                self.note_offs_only = False
+            self.handle(CloseTrackEvent())
+        self.pos = len(self.buf)
+
+    def pending(self) -> bool:
+        # Whether the handler waits for the note offs of notes it saw start,
+        # see parse_range.
+        return False
+
     @abstractmethod
     def handle(self, event: Event):
         pass
+
+
+class TrackScanner(MidiInput):
+    # Walks the events of track chunks reading delta times and event types
+    # only, skipping everything else by length. Subclasses look at the
+    # events they need through event(), meta() and channel(), called for
+    # each event as it is walked.
+
+    def handle(self, event: Event):
+        pass
+
+    def walk_track(self, start: int, length: int) -> int:
+        # Walks the track chunk at START, returns the tick of its last event.
+        self.pos, self.last_status, tick = start, None, 0
+        while self.pos < start + length:
+            pos, last_status = self.pos, self.last_status
+            tick += self.read_varlen()
+            self.event(pos, last_status or 0, tick)
+            status = self.next()
+            if EventType.is_sysex_code(status):
+                self.skip(self.read_varlen())
+            elif EventType.is_meta_code(status):
+                meta_type = self.next()
+                size = self.read_varlen()
+                pos = self.pos
+                self.meta(tick, meta_type, size)
+                self.pos = pos + size
+            else:
+                if status < 0x80:
+                    # Running status, the byte read is the first data byte.
+                    if self.last_status is None:
+                        raise ValueError(f"Unknown event type {hex(status)}")
+                    self.pos -= 1
+                    status = self.last_status
+                self.last_status = status
+                pos = self.pos
+                self.channel(tick, status)
+                self.pos = pos + CHANNEL_LENGTHS[status & 0xF0]
+        return tick
+
+    def event(self, pos: int, status: int, tick: int):
+        # An event at offset POS of the file, after running status STATUS
+        # (0 for none), at TICK of its track.
+        pass
+
+    def meta(self, tick: int, meta_type: int, size: int):
+        # A meta event, its SIZE bytes of data starting at self.pos.
+        pass
+
+    def channel(self, tick: int, status: int):
+        # A channel message, its data bytes starting at self.pos.
+        pass
+
+
+def parse_track(parser: Type[MidiInput], chunk: bytes) -> Tuple[int, object]:
+    # Handles a track with a new PARSER, a TrackMerger, CHUNK being the MThd chunk of its
+    # file followed by the data of its MTrk chunk. Returns the number of
+    # events parsed and the parser's track_result().
+    track = parser(array.array("B", chunk))  # type: ignore[call-arg]
+    track.pos = 4
+    track.parse_mthd()
+    track.handle(OpenTrackEvent())
+    events = 0
+    while not track.done():
+        track.parse_event()
+        events += 1
+    track.handle(CloseTrackEvent())
+    return events, cast(TrackMerger, track).track_result()
+
@@ -1,6 +1,6 @@
 import array
 from math import log2
-from typing import Iterable, List, Literal
+from typing import Iterable, List, Literal, Optional, Sequence, Tuple
 
 from midi.typing import Channel, Velocity
 
@@ -67,7 +67,7 @@ class MidiOutput():
         self.write_u16(count)
 
     def ticks_per_quarter_notes(self, div: int):
-        assert div & 0x80 == 0, "MidiOutput only supports ticks per quarter notes."
+        assert div & 0x8000 == 0, "MidiOutput only supports ticks per quarter notes."
         self.write_u16(div)
 
     def delta_time(self, duration: int = 0):
@@ -85,7 +85,9 @@ class MidiOutput():
         elif num == 2 and den == 4:
             nn, dd, cc, bb = 2, int(log2(4)), 48, 8
         else:
-            assert False, "Unsupported time signature {num} / {den}"
+            assert den & (den - 1) == 0, f"Unsupported time signature {
+                num} / {den}"
+            nn, dd, cc, bb = num, int(log2(den)), 24, 8
         self.append([0xFF, 0x58, 0x04, nn, dd, cc, bb])
 
     def tempo(self, bpm: int, dt: int = 0):
@@ -114,10 +116,73 @@ class MidiOutput():
         self.delta_time(dt)
         self.append([0x80 | chan.value, note, v.value])
 
+    def play(
+        self,
+        clocks: Sequence[int],
+        durations: Sequence[int],
+        notes: Sequence[int],
+        channels: Sequence[int],
+        velocities: Sequence[int],
+        clock: int = 0
+    ) -> int:
+        # Writes a whole set of notes at once: note i starts at clocks[i] and
+        # lasts durations[i] ticks. Note offs go before note ons on the same
+        # tick. CLOCK is the current position in the track, the position
+        # after the last event is returned.
+        events = sorted(
+            [(start + length, 0, 0x80 | chan, note, vel)
+             for start, length, note, chan, vel in zip(
+                clocks, durations, notes, channels, velocities)] +
+            [(start, 1, 0x90 | chan, note, vel)
+             for start, note, chan, vel in zip(
+                clocks, notes, channels, velocities)]
+        )
+        buffer: List[int] = []
+        for tick, _, status, note, vel in events:
+            assert 0 <= note < 128, f"Invalid note {
+                note} must be >= 0 amd < 128."
+            value, clock = tick - clock, tick
+            varlen = [value & 0x7f]
+            value >>= 7
+            while value > 0:
+                varlen.append(0x80 | (value & 0x7f))
+                value >>= 7
+            buffer.extend(reversed(varlen))
+            buffer.extend((status, note, vel))
+        self.append(buffer)
+        return clock
+
     def track_end(self, dt: int = 0):
         self.delta_time(dt)
         self.append([0xFF, 0x2F, 0x00])
 
+    def write_format0(
+        self,
+        clocks: Sequence[int],
+        durations: Sequence[int],
+        notes: Sequence[int],
+        channels: Sequence[int],
+        velocities: Sequence[int],
+        divisions: int = 480,
+        bpm: int = 120,
+        signature: Optional[Tuple[int, int]] = None
+    ):
+        # Writes a whole format 0 file of a single track playing the notes,
+        # see play, SIGNATURE being the (numerator, denominator) of its time
+        # signature.
+        off = self.open_chunk("MThd")
+        self.format(0)
+        self.number_of_tracks(1)
+        self.ticks_per_quarter_notes(divisions)
+        self.close_chunk(off)
+        off = self.open_chunk("MTrk")
+        if signature is not None:
+            self.time_signature(*signature)
+        self.tempo(bpm)
+        self.play(clocks, durations, notes, channels, velocities)
+        self.track_end()
+        self.close_chunk(off)
+
     def save(self, filename: str):
         with open(filename, "wb+") as f:
             f.write(self.buf)
@@ -3,7 +3,7 @@
 import array
 from dataclasses import dataclass
 from enum import Enum
-from typing import Literal, cast
+from typing import Literal, Tuple, Type, cast
 
 
 class Channel(Enum):
@@ -252,6 +252,20 @@ class Instrument(Enum):
     GUNSHOT = 128
 
 
+# Members by value, as tuples: NOTES[60] is much cheaper than Notes(60),
+# which goes through several Python level calls.
+def by_value(enum: Type[Enum]) -> tuple:
+    table = tuple(enum)
+    assert all(member.value == idx for idx, member in enumerate(table)), \
+        f"{enum.__name__} values aren't contiguous from 0."
+    return table
+
+
+NOTES: Tuple[Notes, ...] = by_value(Notes)
+CHANNELS: Tuple[Channel, ...] = by_value(Channel)
+INSTRUMENTS: Tuple[Instrument, ...] = by_value(Instrument)
+
+
 class Format(Enum):
     SingleTrackMultiChannel = 0
     SimultaneousTracks = 1
@@ -2,9 +2,12 @@
 import array
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Tuple, cast
+from typing import Dict, List, Set, Tuple, cast
 
-from midi.input import MidiInput
+import numpy as np
+
+from midi.index import bar_clocks
+from midi.input import MidiInput, TrackMerger
 from midi.typing import (
     Channel,
     Event,
@@ -38,19 +41,84 @@ class NotePlay:
     channel: Channel
     note: Notes
     duration: int
+    velocity: int = 64
+
+
+# Notes of a timeline as arrays, see MidiNorm.notes()
+NOTE_DTYPE = np.dtype([
+    ("clock", np.int64),
+    ("duration", np.int64),
+    ("note", np.uint8),
+    ("channel", np.uint8),
+    ("velocity", np.uint8),
+])
 
 
-class MidiNorm(MidiInput):
+class MidiNorm(MidiInput, TrackMerger):
 
-    runs: Dict[Notes, int] = {}
+    runs: Dict[Notes, Tuple[int, int]]     # Clock and velocity of note ons.
+    sounding: Set[Notes]                   # Notes on and not yet off.
     clock: int = 0
     event_count: int = 0
-    timeline: List[NotePlay] = list([])
+    timeline: List[NotePlay]
+    tracks: List[np.ndarray]    # Notes of the tracks parsed in parallel.
+    signatures: List[Tuple[int, int, int]]
+    divisions: int = 480
     bars: int       # Bars frequency in clock ticks.
     verbose: bool = False
 
-    def add(self, timestamp: int, e: NoteEvent, duration: int):
-        self.timeline.append(NotePlay(timestamp, e.channel, e.note, duration))
+    # The events handle() uses, the others are skipped by the decoder.
+    WANTED = frozenset({
+        EventType.TimeSignature, EventType.Tempo,
+        EventType.NoteOn, EventType.NoteOff,
+    })
+
+    # When decoding a range of bars (see MidiInput.parse_range), notes may
+    # have started before it, their note off is then ignored.
+    partial: bool = False
+
+    def __init__(self, buf: array.array, partial: bool = False):
+        super().__init__(buf, wanted=self.WANTED)
+        self.partial = partial
+        self.runs = {}
+        self.sounding = set()
+        self.timeline = list([])
+        self.tracks = list([])
+        self.signatures = list([])
+
+    def notes(self) -> np.ndarray:
+        # The timeline as a NOTE_DTYPE array sorted by clock.
+        notes = np.array([
+            (play.clock, play.duration, play.note.value, play.channel.value,
+             play.velocity)
+            for play in self.timeline
+        ], dtype=NOTE_DTYPE)
+        notes = np.concatenate([notes] + self.tracks)
+        return notes[np.argsort(notes["clock"], kind="stable")]
+
+    def bar_clocks(self) -> np.ndarray:
+        end = max((play.clock + play.duration for play in self.timeline),
+                  default=0)
+        for notes in self.tracks:
+            end = max(end, int(np.max(notes["clock"] + notes["duration"],
+                                      initial=0)))
+        return bar_clocks(self.signatures, self.divisions, end)
+
+    def track_result(self) -> Tuple[np.ndarray, List[Tuple[int, int, int]]]:
+        # Notes travel back from parse_parallel workers as arrays.
+        return self.notes(), self.signatures
+
+    def merge_track(self, result: Tuple[np.ndarray, List[Tuple[int, int, int]]]):
+        notes, signatures = result
+        self.tracks.append(notes)
+        self.signatures.extend(signatures)
+
+    def pending(self) -> bool:
+        return bool(self.sounding)
+
+    def add(self, timestamp: int, e: NoteEvent, duration: int, velocity: int):
+        self.timeline.append(
+            NotePlay(timestamp, e.channel, e.note, duration, velocity))
 
     def digest(self):
         timeline = sorted(self.timeline, key=lambda play: play.clock)
@@ -71,65 +139,90 @@ class MidiNorm(MidiInput):
         if e.event_type == EventType.HeaderData:
             e = cast(HeaderDataEvent, e)
             self.bars = 4 * e.divisions
-            print(f"{Format(e.format).name}[{e.format.value}]: {
-                  e.number_of_tracks} tracks, {e.divisions}.")
+            self.divisions = e.divisions
+            if self.verbose:
+                print(f"{Format(e.format).name}[{e.format.value}]: {
+                      e.number_of_tracks} tracks, {e.divisions}.")
         elif e.event_type == EventType.TimeSignature:
             e = cast(TimeSignatureEvent, e)
-            print(f"Time signature: {e.nn}/{e.dd **
-                  2} - cc: {e.cc}, bb: {e.bb}")
+            self.signatures.append((self.clock, e.nn, e.dd))
+            if self.verbose:
+                print(f"Time signature: {e.nn}/{e.dd **
+                      2} - cc: {e.cc}, bb: {e.bb}")
         elif e.event_type == EventType.Tempo:
             e = cast(TempoEvent, e)
-            print(f"Tempo {e.bpm}")
+            if self.verbose:
+                print(f"Tempo {e.bpm}")
         elif e.event_type == EventType.OpenTrack:
             self.runs = {}
+            self.sounding = set()
             self.clock = 0
-            print("Open track.")
+            if self.verbose:
+                print("Open track.")
         elif e.event_type == EventType.CloseTrack:
             self.event_count = 0
-            print("Close track.")
+            if self.verbose:
+                print("Close track.")
         if not e.event_type.is_channel():
             return
         if e.event_type == EventType.NoteOn:
             e = cast(NoteOnEvent, e)
-            self.runs[e.note] = self.clock
+            self.runs[e.note] = (self.clock, e.velocity)
+            self.sounding.add(e.note)
         elif e.event_type == EventType.NoteOff:
             e = cast(NoteOffEvent, e)
-            start = self.runs.get(e.note, -1)
+            if self.note_offs_only and e.note not in self.sounding:
+                # Past a range, of a note started past it too.
+                return
+            self.sounding.discard(e.note)
+            start, velocity = self.runs.get(e.note, (-1, 0))
+            if start < 0 and self.partial:
+                return
             assert start >= 0, f"@ {e.dt} note {e.note} stopped not started."
-            self.add(start, e, self.clock - start)
+            self.add(start, e, self.clock - start, velocity)
 
 
-def parse_midi(filename: Path | str):
+def parse_midi(source: Path | str | bytes):
+    # SOURCE is a file name or the content of a midi file, e.g. as read from
+    # an archive.
     clocks_per_bar = 4*480  # wtc -> 4 * divisions = 4 * 120 = 480
     channel_width = 18
     max_channels = 5
-    with open(filename, 'rb') as file:
-        # Read the entire file content as bytes
-        content = file.read()
-        parser = MidiNorm(array.array('B', content))
-        parser.parse()
-        bar_number = 0
-        for clock, plays in parser.digest():
-            # Displays the bar if needed.
-            while clock // clocks_per_bar >= bar_number:
-                print(f"== BAR {1 + bar_number} " + "=" * (max_channels * channel_width)
-                      )
-                bar_number += 1
-
-            # Displays the playing notes (nicely).
-            bychan = {play.channel: play for play in plays}
-
-            def format(ch: Channel) -> str:
-                if ch.value > max_channels:
-                    return ""
-                play = bychan.get(ch, None)
-                if play is None:
-                    return " " * channel_width
-                else:
-                    text = f"{play.duration:>3}:{play.note}"
-                    return f"{text:<{channel_width}}"
-
-            print(f"{clock:>6} {''.join([format(ch) for ch in Channel])}")
-
-
-parse_midi(DATADIR / filename)
+    if isinstance(source, bytes):
+        content = source
+    else:
+        with open(source, 'rb') as file:
+            # Read the entire file content as bytes
+            content = file.read()
+    parser = MidiNorm(array.array('B', content))
+    parser.parse()
+    bar_number = 0
+    for clock, plays in parser.digest():
+        # Displays the bar if needed.
+        while clock // clocks_per_bar >= bar_number:
+            print(f"== BAR {1 + bar_number} " + "=" * (max_channels * channel_width)
+                  )
+            bar_number += 1
+
+        # Displays the playing notes (nicely).
+        bychan = {play.channel: play for play in plays}
+
+        def format(ch: Channel) -> str:
+            if ch.value > max_channels:
+                return ""
+            play = bychan.get(ch, None)
+            if play is None:
+                return " " * channel_width
+            else:
+                text = f"{play.duration:>3}:{play.note}"
+                return f"{text:<{channel_width}}"
+
+        print(f"{clock:>6} {''.join([format(ch) for ch in Channel])}")
+
+
+def main():
+    parse_midi(DATADIR / filename)
+
+
+if __name__ == "__main__":
+    main()
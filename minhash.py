@@ -0,0 +1,257 @@
+# Near-duplicate detection over midi timelines and kern scores. Each piece is
+# reduced to its melody line, the highest pitch of each onset, whose n-grams
+# of pitch intervals make a transposition invariant set of shingles. MinHash
+# signatures estimate the Jaccard similarity of these sets, and banding the
+# signatures (locality sensitive hashing) yields the candidate pairs without
+# comparing all pairs of pieces. Signatures are computed for batches of
+# pieces at once, as multiply-shift hashes of the shingles reduced per piece.
+import sys
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from archive import Reader, Source, map_slices
+from humdrum import HumdrumParser, Symbol
+from intervals import ranges
+from kern2midi import render_spine
+from manifest import cache_path
+
+NGRAM = 5
+PERMUTATIONS = 128
+BANDS = 16          # Of PERMUTATIONS // BANDS rows, see band_threshold().
+THRESHOLD = 0.8
+
+# Signature of pieces without shingles, never a candidate.
+EMPTY = np.uint32(0xFFFFFFFF)
+# Most shingles hashed at once, and permutations hashed per pass over them,
+# sized so that the hashes of a pass stay in cache.
+BATCH = 1 << 16
+CHUNK = 32
+# Index of the high half of a uint64 viewed as two uint32.
+HIGH = 1 if sys.byteorder == "little" else 0
+
+PERCUSSION = 9      # Midi channel 10, whose notes aren't pitches.
+
+
+def skyline(onsets: np.ndarray, pitches: np.ndarray) -> np.ndarray:
+    # The highest of PITCHES at each onset, in onset order.
+    order = np.lexsort((-pitches.astype(np.int64), onsets))
+    onsets, pitches = onsets[order], pitches[order]
+    first = np.ones(len(onsets), dtype=bool)
+    first[1:] = onsets[1:] != onsets[:-1]
+    return pitches[first]
+
+
+def timeline_pitches(notes: np.ndarray) -> np.ndarray:
+    # Melody of a timeline, see midinorm.NOTE_DTYPE.
+    notes = notes[notes["channel"] != PERCUSSION]
+    return skyline(notes["clock"], notes["note"])
+
+
+def spine_pitches(spines: Dict[str, List[Symbol]]) -> np.ndarray:
+    # Melody of the spines of a kern score, as played by kern2midi.
+    onsets = [np.empty(0, dtype=np.int64)]
+    pitches = [np.empty(0, dtype=np.int64)]
+    for spine in spines.values():
+        clocks, _, numbers = render_spine(spine)
+        onsets.append(clocks)
+        pitches.append(numbers)
+    return skyline(np.concatenate(onsets), np.concatenate(pitches))
+
+
+def mix(values: np.ndarray) -> np.ndarray:
+    # Finalizer of splitmix64, spreads structured keys over all 64 bits.
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def shingles(pitches: np.ndarray, ngram: int = NGRAM) -> np.ndarray:
+    # The distinct hashed NGRAM-grams of the intervals between PITCHES, the
+    # whole sequence being a single shingle when shorter. Each interval takes
+    # a byte of the key, so NGRAM is at most 8.
+    steps = np.clip(np.diff(np.asarray(pitches, dtype=np.int64)), -127, 127)
+    steps = (steps + 128).astype(np.uint64)
+    if len(steps) == 0:
+        return np.empty(0, dtype=np.uint64)
+    width = min(ngram, len(steps))
+    count = len(steps) - width + 1
+    keys = np.zeros(count, dtype=np.uint64)
+    for offset in range(width):
+        keys |= steps[offset:offset + count] << np.uint64(8 * offset)
+    return np.unique(mix(keys))
+
+
+def permutations(count: int = PERMUTATIONS, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    # Parameters of the hashes (a * x + b) mod 2**64 >> 32, a being odd.
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 1 << 63, count, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 1 << 63, count, dtype=np.uint64)
+    return a, b
+
+
+def signatures(
+    sets: Sequence[np.ndarray],
+    count: int = PERMUTATIONS,
+    seed: int = 0
+) -> np.ndarray:
+    # The (len(SETS), COUNT) uint32 MinHash signatures of the shingle SETS.
+    # Sets are hashed in batches of about BATCH shingles, whose minimum per
+    # set is taken with a single reduceat per chunk of permutations. Hashes
+    # are computed in place, the shift being a view of their high halves.
+    a, b = permutations(count, seed)
+    out = np.full((len(sets), count), EMPTY, dtype=np.uint32)
+    lengths = np.array([len(shingles) for shingles in sets], dtype=np.int64)
+    ends = np.cumsum(lengths)
+    start = 0
+    while start < len(sets):
+        base = ends[start] - lengths[start]
+        stop = max(start + 1, int(np.searchsorted(ends, base + BATCH, "right")))
+        batch = start + np.flatnonzero(lengths[start:stop])
+        start = stop
+        if not batch.size:
+            continue
+        values = np.concatenate([sets[idx] for idx in batch])
+        offsets = ends[batch] - lengths[batch] - base
+        buffer = np.empty((CHUNK, len(values)), dtype=np.uint64)
+        for first in range(0, count, CHUNK):
+            last = min(first + CHUNK, count)
+            hashed = buffer[:last - first]
+            np.multiply(a[first:last, None], values, out=hashed)
+            np.add(hashed, b[first:last, None], out=hashed)
+            high = hashed.view(np.uint32)[:, HIGH::2]
+            out[batch, first:last] = np.minimum.reduceat(high, offsets, axis=1).T
+    return out
+
+
+def band_threshold(count: int = PERMUTATIONS, bands: int = BANDS) -> float:
+    # Similarity at which pieces become candidates with even odds.
+    return (1 / bands) ** (bands / count)
+
+
+def candidates(sigs: np.ndarray, bands: int = BANDS) -> np.ndarray:
+    # The (M, 2) pairs i < j of pieces whose signatures agree on all the
+    # rows of at least one of BANDS bands.
+    count, width = sigs.shape
+    rows = width // bands
+    valid = np.flatnonzero(sigs[:, 0] != EMPTY)
+    found = [np.empty(0, dtype=np.int64)]
+    for band in range(bands):
+        block = sigs[valid, band * rows:(band + 1) * rows].astype(np.uint64)
+        keys = np.full(len(valid), band, dtype=np.uint64)
+        for row in range(rows):
+            keys = mix(keys ^ block[:, row])
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        # Pairs each piece with those after it in its run of equal keys.
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        runs = np.diff(np.r_[starts, len(keys)])
+        if not (runs > 1).any():
+            continue
+        last = np.repeat(starts + runs, runs)
+        owners, positions = ranges(np.arange(1, len(keys) + 1), last)
+        i, j = valid[order[owners]], valid[order[positions]]
+        found.append(np.minimum(i, j) * count + np.maximum(i, j))
+    pairs = np.unique(np.concatenate(found))
+    return np.stack((pairs // count, pairs % count), axis=1)
+
+
+def similarity(sigs: np.ndarray, pairs: np.ndarray) -> np.ndarray:
+    # Estimated Jaccard similarity of each of PAIRS.
+    out = np.empty(len(pairs), dtype=np.float64)
+    step = max(1, BATCH // sigs.shape[1])
+    for first in range(0, len(pairs), step):
+        chunk = pairs[first:first + step]
+        out[first:first + len(chunk)] = (
+            sigs[chunk[:, 0]] == sigs[chunk[:, 1]]).mean(axis=1)
+    return out
+
+
+def near_duplicates(
+    sigs: np.ndarray,
+    bands: int = BANDS,
+    threshold: float = THRESHOLD
+) -> Tuple[np.ndarray, np.ndarray]:
+    # The candidate pairs whose estimated similarity is at least THRESHOLD,
+    # along with that similarity.
+    pairs = candidates(sigs, bands)
+    scores = similarity(sigs, pairs)
+    keep = scores >= threshold
+    return pairs[keep], scores[keep]
+
+
+def clusters(pairs: np.ndarray, count: int) -> np.ndarray:
+    # Labels the COUNT pieces by connected components of PAIRS, a component
+    # being labeled by its smallest piece.
+    labels = np.arange(count)
+    while True:
+        low = np.minimum(labels[pairs[:, 0]], labels[pairs[:, 1]])
+        updated = labels.copy()
+        np.minimum.at(updated, pairs[:, 0], low)
+        np.minimum.at(updated, pairs[:, 1], low)
+        # Pointer jumping, so that chains collapse in a few rounds.
+        while not np.array_equal(updated, updated[updated]):
+            updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+@dataclass
+class Shingled:
+    # Shingles of a piece, or the reason they couldn't be computed, along
+    # with the digest of the file read, see manifest.
+    source: Source
+    shingles: Optional[np.ndarray] = None
+    error: Optional[str] = None
+    digest: Optional[str] = None
+
+
+def shingle_sources(
+    sources: List[Source],
+    notes_dir: Path,
+    notes_suffix: str,
+    ngram: int = NGRAM
+) -> List[Shingled]:
+    # Kern scores are parsed, midi files are looked up in NOTES_DIR for the
+    # timeline written by midi-norm.
+    out: List[Shingled] = []
+    with Reader() as reader:
+        for source in sources:
+            shingled = Shingled(source)
+            try:
+                if source.suffix.lower() == ".krn":
+                    parser = HumdrumParser(reader.text(source))
+                    parser.parse()
+                    pitches = spine_pitches(parser.spines)
+                else:
+                    timeline = cache_path(notes_dir, source, notes_suffix)
+                    if not timeline.exists():
+                        raise FileNotFoundError(
+                            f"No timeline {timeline}, run midi-norm first.")
+                    pitches = timeline_pitches(np.load(timeline))
+                shingled.shingles = shingles(pitches, ngram)
+            except Exception as e:
+                shingled.error = f"{type(e).__name__}: {e}"
+            shingled.digest = reader.digests.pop(source, None)
+            out.append(shingled)
+    return out
+
+
+def shingle_all(
+    sources: Sequence[Source],
+    notes_dir: Path,
+    notes_suffix: str,
+    ngram: int = NGRAM,
+    jobs: int = 1,
+    profile: Optional[Path] = None
+) -> Iterator[Shingled]:
+    # Shingles SOURCES in JOBS processes, in order, see archive.map_slices.
+    return map_slices(partial(shingle_sources, notes_dir=notes_dir,
+                              notes_suffix=notes_suffix, ngram=ngram),
+                      sources, jobs, profile)
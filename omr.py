@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+# Batch entry point of the pipeline:
+#   omr midi-norm   midi files -> sorted note arrays and bar clocks,
+#   omr kern-parse  kern scores -> token arrays, one per spine,
+#   omr pdf-cut     pdf scores -> line crops with their bar counts,
+#   omr align       line crops + bar clocks -> per line clock/note ranges.
+#   omr catalog     midi and kern files -> metadata in a SQLite database.
+#   omr dedup       midi timelines + kern scores -> near-duplicate pairs.
+# Every subcommand takes files, directories and glob patterns, writes its
+# outputs to --cache-dir, keyed by the input's path, and processes the
+# inputs in --jobs worker processes. Inputs whose outputs are up to date
+# according to the manifest of the cache directory are skipped, unless
+# --force is given.
+import array
+import glob
+import os
+import sqlite3
+import sys
+from functools import partial
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import click
+import numpy as np
+
+import catalog
+import minhash
+import profiling
+from align import align_lines, save_alignment
+from archive import Reader, Source, is_archive, map_slices, members
+from humdrum import HumdrumParser
+from lazy import lazy_import
+from manifest import Manifest, cache_path, stage_versions
+from midi.index import build_index, save_index
+from midinorm import MidiNorm
+from pdf2img import (
+    PageProfile,
+    cut_sheet,
+    deskew,
+    export_crops,
+    find_bars,
+    find_staff,
+    find_staff_pyramid,
+    load_angles,
+    load_crops,
+    preprocess_batch,
+    save_angles,
+)
+from tokens import encode
+
+cv2 = lazy_import("cv2")
+
+MIDI_SUFFIXES = (".mid", ".midi")
+KERN_SUFFIXES = (".krn",)
+PDF_SUFFIXES = (".pdf",)
+
+# Task outputs in the cache directory.
+NOTES_SUFFIX = ".notes.npy"
+BARINDEX_SUFFIX = ".barindex.npz"
+BARS_SUFFIX = ".bars.npy"
+TOKENS_SUFFIX = ".tokens.npz"
+CROPS_SUFFIX = ".crops"      # See pdf2img.crops_path, it writes the two below.
+CROPS_DATA_SUFFIX = ".npy"
+CROPS_INDEX_SUFFIX = ".index.npz"
+ALIGN_SUFFIX = ".align.npy"
+SHINGLES_SUFFIX = ".shingles.npy"
+SKEW_SUFFIX = ".skew.npz"
+
+
+def expand(patterns: Sequence[str], suffixes: Sequence[str]) -> List[Source]:
+    # Resolves PATTERNS into a list of files: directories are walked for
+    # files ending with one of SUFFIXES, glob patterns are expanded (** is
+    # recursive) and anything else is taken as a file name. Archives found
+    # along the way are replaced by their members ending with SUFFIXES.
+    # Duplicates are dropped, keeping the first occurrence.
+    paths: List[Path] = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.extend(sorted(
+                path for path in Path(pattern).rglob("*")
+                if (path.suffix.lower() in suffixes or is_archive(path)) and
+                path.is_file()
+            ))
+        elif glob.has_magic(pattern):
+            paths.extend(Path(path) for path in sorted(
+                glob.glob(pattern, recursive=True)) if os.path.isfile(path))
+        else:
+            paths.append(Path(pattern))
+    sources: List[Source] = []
+    for path in dict.fromkeys(paths):
+        if is_archive(path) and path.is_file():
+            sources.extend(members(path, suffixes))
+        else:
+            sources.append(path)
+    return sources
+
+
+# A task processes one source, reading it through the reader when needed,
+# and returns a message describing its outputs. Results also carry the
+# profiling report and the digest of the source, when it was read.
+TaskFn = Callable[[Source, Reader], str]
+Result = Tuple[bool, str, Optional[str]]
+
+
+class Task:
+    # Runs FN on a slice of sources in a worker process, opening archives
+    # once per slice and turning exceptions into error messages so that one
+    # bad file doesn't bring down the batch. Each result comes with the
+    # digest of the source's content, when read.
+
+    fn: TaskFn
+    name: str
+
+    def __init__(self, fn: TaskFn, name: str):
+        self.fn = fn
+        self.name = name
+
+    def __call__(self, sources: List[Source]) -> List[Result]:
+        results = []
+        with Reader() as reader:
+            for source in sources:
+                ok = True
+                try:
+                    with profiling.timer(self.name):
+                        message = self.fn(source, reader)
+                except Exception as e:
+                    ok, message = False, f"{type(e).__name__}: {e}"
+                results.append((ok, message, reader.digests.pop(source, None)))
+        return results
+
+
+def run(
+    fn: TaskFn,
+    name: str,
+    sources: Sequence[Source],
+    jobs: Optional[int],
+    profile: Optional[Path],
+    done: Optional[Callable[[Source, Result], None]] = None
+) -> int:
+    # Applies FN to all SOURCES, in JOBS processes (all cpus by default,
+    # inline for a single job), echoing each result in order, see
+    # map_slices. Returns the number of failures. With a PROFILE ending in
+    # .json, the counters and timers of all calls are merged into it,
+    # otherwise their cProfile stats are. DONE is called with each source
+    # and its result as they come in.
+    jobs = min(jobs or os.cpu_count() or 1, max(len(sources), 1))
+    results = map_slices(Task(fn, name), sources, jobs, profile)
+    failed = 0
+    for source, result in zip(sources, results):
+        ok, message, _ = result
+        click.echo(f"{source}: {message}", err=not ok)
+        failed += not ok
+        if done:
+            done(source, result)
+    click.echo(f"Processed {len(sources)} files, {failed} failed.", err=True)
+    return failed
+
+
+profile_option = click.option(
+    "--profile", type=click.Path(dir_okay=False, path_type=Path),
+    help="Writes the merged cProfile stats to this file, or the counters "
+    "and timers if it ends with .json.")
+
+
+def batch(
+    suffixes: Sequence[str],
+    stages: Sequence[str],
+    outputs: Sequence[str],
+    depends: Sequence[str] = (),
+    ignore: Sequence[str] = ()
+):
+    # Decorates a subcommand with the PATHS argument and the options shared
+    # by all subcommands. The command gets its own options and returns the
+    # task that run() then applies to each of the expanded paths.
+    # The manifest keeps the versions of STAGES along with the command's
+    # options, bar those in IGNORE which don't change its outputs, for each
+    # source processed. A source is skipped when they are unchanged, as are
+    # the source itself and the cache files it DEPENDS on, and its OUTPUTS
+    # exist. DEPENDS and OUTPUTS are suffixes, as for cache_path().
+    def decorator(command):
+        def wrapper(
+            paths: Tuple[str, ...],
+            jobs: Optional[int],
+            cache_dir: Path,
+            profile: Optional[Path],
+            force: bool,
+            **kwargs
+        ):
+            files = expand(paths, suffixes)
+            if not files:
+                raise click.UsageError("No input files.")
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            name = command.__name__
+            manifest = Manifest(cache_dir)
+            versions = stage_versions(stages)
+            params = {key: value for key, value in kwargs.items()
+                      if key not in ignore}
+
+            def inputs(source: Source) -> List[Path]:
+                return [cache_path(cache_dir, source, suffix)
+                        for suffix in depends]
+
+            def fresh(source: Source, reader: Reader) -> bool:
+                return (all(cache_path(cache_dir, source, suffix).exists()
+                            for suffix in outputs) and
+                        manifest.fresh(name, source, versions, params,
+                                       inputs(source), reader))
+
+            def done(source: Source, result: Result):
+                ok, _, content = result
+                if ok:
+                    manifest.record(name, source, versions, params,
+                                    inputs(source), content)
+                else:
+                    manifest.forget(name, source)
+
+            if not force:
+                with Reader() as reader:
+                    stale = [source for source in files
+                             if not fresh(source, reader)]
+                if len(stale) < len(files):
+                    click.echo(f"Skipped {len(files) - len(stale)} up to date "
+                               "files.", err=True)
+                files = stale
+            if not files:
+                # The refreshed modification times still need saving.
+                manifest.save()
+                return
+            fn = command(cache_dir=cache_dir, **kwargs)
+            try:
+                failed = run(fn, name, files, jobs, profile, done)
+            finally:
+                # Also keeps the results in so far when interrupted.
+                manifest.save()
+            if failed:
+                sys.exit(1)
+
+        wrapper.__name__ = command.__name__
+        wrapper.__doc__ = command.__doc__
+        for option in reversed((
+            click.argument("paths", nargs=-1, required=True),
+            click.option("--jobs", "-j", type=click.IntRange(min=1),
+                         help="Worker processes, defaults to all cpus."),
+            click.option("--cache-dir", default="cache", show_default=True,
+                         type=click.Path(file_okay=False, path_type=Path),
+                         help="Where outputs are written and read."),
+            profile_option,
+            click.option("--force", is_flag=True,
+                         help="Processes all inputs, even those up to date."),
+        )):
+            wrapper = option(wrapper)
+        return wrapper
+    return decorator
+
+
+def norm_midi(
+    path: Source,
+    reader: Reader,
+    cache_dir: Path,
+    track_jobs: int = 1,
+    bar_index: bool = False
+) -> str:
+    buf = array.array("B", reader.read(path))
+    if bar_index:
+        save_index(cache_path(cache_dir, path, BARINDEX_SUFFIX), build_index(buf))
+    parser = MidiNorm(buf)
+    parser.parse_parallel(track_jobs)
+    notes, bars = parser.notes(), parser.bar_clocks()
+    np.save(cache_path(cache_dir, path, NOTES_SUFFIX), notes)
+    np.save(cache_path(cache_dir, path, BARS_SUFFIX), bars)
+    return f"{len(notes)} notes, {len(bars) - 1} bars"
+
+
+def parse_kern(path: Source, reader: Reader, cache_dir: Path) -> str:
+    parser = HumdrumParser(reader.text(path))
+    parser.parse()
+    spines = {name: encode(spine) for name, spine in parser.spines.items()}
+    np.savez(cache_path(cache_dir, path, TOKENS_SUFFIX), **spines)
+    count = sum(len(tokens) for tokens in spines.values())
+    return f"{len(spines)} spines, {count} tokens"
+
+
+def cut_pdf(
+    path: Source,
+    reader: Reader,
+    cache_dir: Path,
+    width: int,
+    height: int,
+    straighten: bool,
+    staff_levels: int
+) -> str:
+    # With STRAIGHTEN, pages are deskewed first, by the angles estimated on
+    # a previous run of the same pdf when there are any. With STAFF_LEVELS,
+    # staff lines are searched for coarse to fine, see find_staff_pyramid.
+    from pdf2image import convert_from_bytes
+
+    images = [cv2.cvtColor(np.asarray(page), cv2.COLOR_RGB2GRAY)
+              for page in convert_from_bytes(reader.read(path))]
+    if straighten:
+        skew = cache_path(cache_dir, path, SKEW_SUFFIX)
+        angles = load_angles(skew, reader.digests[path])
+        if angles is None or len(angles) != len(images):
+            angles = np.full(len(images), np.nan)
+        for pageno, (image, angle) in enumerate(zip(images, angles)):
+            images[pageno], angles[pageno] = deskew(
+                image, None if np.isnan(angle) else float(angle))
+        save_angles(skew, reader.digests[path], angles)
+    pages, heights = preprocess_batch(images, width=width, jobs=1)
+    crops, boxes, numbers, bars = [], [], [], []
+    for pageno, (page, page_height) in enumerate(zip(pages, heights)):
+        page = page[:page_height]
+        profile = PageProfile(page)
+        if staff_levels:
+            staff = find_staff_pyramid(page, staff_levels)
+        else:
+            staff = find_staff(page, profile)
+        page_boxes, page_crops = cut_sheet(page, staff, interactive=False)
+        crops.extend(page_crops)
+        boxes.append(page_boxes)
+        numbers.extend([pageno] * len(page_crops))
+        bars.extend(find_bars(profile, staff))
+    export_crops(cache_path(cache_dir, path, CROPS_SUFFIX), crops,
+                 np.concatenate(boxes), np.array(numbers), bars, height=height)
+    return f"{len(pages)} pages, {len(crops)} lines"
+
+
+def align_score(
+    path: Source,
+    reader: Reader,
+    cache_dir: Path,
+    first_bar: int
+) -> str:
+    # Only reads the outputs of pdf-cut and midi-norm.
+    _, index = load_crops(cache_path(cache_dir, path, CROPS_SUFFIX))
+    notes = np.load(cache_path(cache_dir, path, NOTES_SUFFIX), mmap_mode="r")
+    bars = np.load(cache_path(cache_dir, path, BARS_SUFFIX))
+    alignment = align_lines(index["bar_counts"], bars, notes["clock"], first_bar)
+    save_alignment(cache_path(cache_dir, path, ALIGN_SUFFIX), alignment)
+    return f"{len(alignment)} lines, {int(index['bar_counts'].sum())} bars"
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("midi-norm")
+@click.option("--track-jobs", default=1, show_default=True,
+              type=click.IntRange(min=1),
+              help="Processes decoding the tracks of each file.")
+@click.option("--bar-index", is_flag=True,
+              help="Also writes the bar index of each file, see midi.index.")
+@batch(MIDI_SUFFIXES, stages=("midi-decode", "midi-normalize"),
+       outputs=(NOTES_SUFFIX, BARS_SUFFIX), ignore=("track_jobs",))
+def midi_norm(cache_dir: Path, track_jobs: int, bar_index: bool):
+    """Normalizes midi files into note arrays and bar clocks."""
+    return partial(norm_midi, cache_dir=cache_dir, track_jobs=track_jobs,
+                   bar_index=bar_index)
+
+
+@cli.command("kern-parse")
+@batch(KERN_SUFFIXES, stages=("kern-parse", "kern-tokenize"),
+       outputs=(TOKENS_SUFFIX,))
+def kern_parse(cache_dir: Path):
+    """Parses kern scores into token arrays, one per spine."""
+    return partial(parse_kern, cache_dir=cache_dir)
+
+
+@cli.command("pdf-cut")
+@click.option("--width", default=1200, show_default=True,
+              help="Width pages are scaled to.")
+@click.option("--height", default=256, show_default=True,
+              help="Height of the exported line crops.")
+@click.option("--deskew", "straighten", is_flag=True,
+              help="Straightens skewed pages, e.g. scans, before cutting.")
+@click.option("--staff-levels", default=0, show_default=True,
+              type=click.IntRange(min=0),
+              help="Finds staff lines coarse to fine from pages downsampled "
+              "this many times, 0 searches whole pages. Faster on large "
+              "--width.")
+@batch(PDF_SUFFIXES, stages=("rasterize", "deskew", "staff-detect", "cut"),
+       outputs=(CROPS_DATA_SUFFIX, CROPS_INDEX_SUFFIX))
+def pdf_cut(
+    cache_dir: Path,
+    width: int,
+    height: int,
+    straighten: bool,
+    staff_levels: int
+):
+    """Cuts pdf scores into line crops, with the bar count of each line."""
+    return partial(cut_pdf, cache_dir=cache_dir, width=width, height=height,
+                   straighten=straighten, staff_levels=staff_levels)
+
+
+@cli.command("align")
+@click.option("--first-bar", default=0, show_default=True,
+              help="Performance bar the first line starts on.")
+@batch(PDF_SUFFIXES, stages=("align",),
+       outputs=(ALIGN_SUFFIX,),
+       depends=(CROPS_INDEX_SUFFIX, NOTES_SUFFIX, BARS_SUFFIX))
+def align(cache_dir: Path, first_bar: int):
+    """Aligns line crops with the bars of a performance.
+
+    PATHS are pdf scores. Their crops and performance are looked up in the
+    cache by the path of each score less its suffix, so pdf-cut and
+    midi-norm must have been run on a pdf and a midi file of the same name
+    in the same directory.
+    """
+    return partial(align_score, cache_dir=cache_dir, first_bar=first_bar)
+
+
+@cli.command("catalog")
+@click.argument("paths", nargs=-1)
+@click.option("--db", default="catalog.sqlite", show_default=True,
+              type=click.Path(dir_okay=False, path_type=Path),
+              help="The catalog database.")
+@click.option("--jobs", "-j", default=1, show_default=True,
+              type=click.IntRange(min=1), help="Worker processes.")
+@click.option("--prune", is_flag=True,
+              help="Removes the files that no longer exist.")
+@click.option("--query", "-q",
+              help="SQL query to run once refreshed, rows are tab separated.")
+@profile_option
+@click.option("--force", is_flag=True,
+              help="Scans all files, even those unchanged.")
+def catalog_files(
+    paths: Tuple[str, ...],
+    db: Path,
+    jobs: int,
+    prune: bool,
+    query: Optional[str],
+    profile: Optional[Path],
+    force: bool
+):
+    """Catalogs the metadata of midi and kern files into a database.
+
+    Only new files and those that changed since the last run are scanned.
+    """
+    connection = catalog.connect(db)
+    try:
+        files = expand(paths, MIDI_SUFFIXES + KERN_SUFFIXES)
+        if files:
+            scans, skipped = catalog.refresh(connection, files, jobs, force,
+                                             profile)
+            for scan in scans:
+                if scan.error:
+                    click.echo(f"{scan.source}: {scan.error}", err=True)
+            failed = sum(scan.error is not None for scan in scans)
+            click.echo(f"Scanned {len(scans)} files, {failed} failed, "
+                       f"{skipped} unchanged.", err=True)
+        if prune:
+            click.echo(f"Removed {catalog.prune(connection)} files.", err=True)
+        if query:
+            try:
+                rows = connection.execute(query)
+            except sqlite3.Error as e:
+                raise click.ClickException(f"Invalid query: {e}")
+            for row in rows:
+                click.echo("\t".join(map(str, row)))
+    finally:
+        connection.close()
+
+
+@cli.command("dedup")
+@click.argument("paths", nargs=-1, required=True)
+@click.option("--cache-dir", default="cache", show_default=True,
+              type=click.Path(file_okay=False, path_type=Path),
+              help="Where midi-norm wrote the timelines of the midi files, "
+              "and the shingles are kept.")
+@click.option("--jobs", "-j", default=1, show_default=True,
+              type=click.IntRange(min=1), help="Worker processes.")
+@click.option("--ngram", default=minhash.NGRAM, show_default=True,
+              type=click.IntRange(1, 8), help="Intervals per shingle.")
+@click.option("--permutations", default=minhash.PERMUTATIONS,
+              show_default=True, type=click.IntRange(min=1),
+              help="Length of the MinHash signatures.")
+@click.option("--bands", default=minhash.BANDS, show_default=True,
+              type=click.IntRange(min=1),
+              help="LSH bands, more find less similar candidates.")
+@click.option("--threshold", default=minhash.THRESHOLD, show_default=True,
+              type=click.FloatRange(0, 1),
+              help="Least estimated similarity of the pairs reported.")
+@click.option("--seed", default=0, show_default=True,
+              help="Seed of the MinHash permutations.")
+@profile_option
+@click.option("--force", is_flag=True,
+              help="Shingles all pieces, even those whose shingles are "
+              "up to date.")
+def dedup(
+    paths: Tuple[str, ...],
+    cache_dir: Path,
+    jobs: int,
+    ngram: int,
+    permutations: int,
+    bands: int,
+    threshold: float,
+    seed: int,
+    profile: Optional[Path],
+    force: bool
+):
+    """Finds near-duplicates among midi files and kern scores.
+
+    Pieces are compared by the pitch intervals of their melody, so that
+    transpositions match. Prints each pair found along with its estimated
+    similarity, followed by a blank line and the groups of duplicates, one
+    per line. The shingles of each piece are kept in the cache.
+    """
+    if permutations % bands:
+        raise click.UsageError("--permutations must be a multiple of --bands.")
+    files = expand(paths, MIDI_SUFFIXES + KERN_SUFFIXES)
+    if not files:
+        raise click.UsageError("No input files.")
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    manifest = Manifest(cache_dir)
+    versions = stage_versions(("melody-shingle",))
+    params = dict(ngram=ngram)
+
+    def inputs(source: Source) -> List[Path]:
+        # Midi files are shingled from their timeline.
+        if source.suffix.lower() in KERN_SUFFIXES:
+            return []
+        return [cache_path(cache_dir, source, NOTES_SUFFIX)]
+
+    cached = {}
+    if not force:
+        with Reader() as reader:
+            for source in files:
+                path = cache_path(cache_dir, source, SHINGLES_SUFFIX)
+                if path.exists() and manifest.fresh(
+                        "dedup", source, versions, params, inputs(source),
+                        reader):
+                    cached[source] = np.load(path)
+    try:
+        for shingled in minhash.shingle_all(
+                [source for source in files if source not in cached],
+                cache_dir, NOTES_SUFFIX, ngram, jobs, profile):
+            source = shingled.source
+            if shingled.error:
+                click.echo(f"{source}: {shingled.error}", err=True)
+                manifest.forget("dedup", source)
+                continue
+            np.save(cache_path(cache_dir, source, SHINGLES_SUFFIX),
+                    shingled.shingles)
+            manifest.record("dedup", source, versions, params,
+                            inputs(source), shingled.digest)
+            cached[source] = shingled.shingles
+    finally:
+        manifest.save()
+    sources = [source for source in files if source in cached]
+    sets = [cached[source] for source in sources]
+    sigs = minhash.signatures(sets, permutations, seed)
+    pairs, scores = minhash.near_duplicates(sigs, bands, threshold)
+    for (i, j), score in zip(pairs.tolist(), scores.tolist()):
+        click.echo(f"{sources[i]}\t{sources[j]}\t{score:.3f}")
+    labels = minhash.clusters(pairs, len(sources))
+    grouped = np.flatnonzero(np.isin(labels, labels[pairs.ravel()]))
+    grouped = grouped[np.argsort(labels[grouped], kind="stable")]
+    groups = (np.split(grouped, np.flatnonzero(np.diff(labels[grouped])) + 1)
+              if grouped.size else [])
+    if groups:
+        click.echo()
+    for group in groups:
+        click.echo("\t".join(str(sources[idx]) for idx in group))
+    click.echo(f"Compared {len(sources)} pieces, {len(files) - len(sources)} "
+               f"failed, {len(pairs)} pairs in {len(groups)} groups.", err=True)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,16 +1,31 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
+import os
 import pickle
-import sys
-from dataclasses import dataclass, replace
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional, Tuple, cast
+from typing import (
+    TYPE_CHECKING,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    cast,
+)
 
-import cv2
-import matplotlib.pyplot as plt
 import numpy as np
-from cv2.typing import MatLike
-from pdf2image import convert_from_path
+
+import profiling
+from lazy import lazy_import
+
+if TYPE_CHECKING:
+    import cv2
+    from cv2.typing import MatLike
+else:
+    cv2 = lazy_import("cv2")
 
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
@@ -53,10 +68,11 @@ def save_numpy(target: Path | str, array: MatLike):
 
 def load_numpy(source: Path) -> MatLike:
     with open(DATADIR / source, "rb") as f:
-        return cast(MatLike, pickle.load(f))
+        return cast("MatLike", pickle.load(f))
 
 
 def get_page(pdf: Path | str, pageno: int) -> MatLike:
+    from pdf2image import convert_from_path
     pages = convert_from_path(pdf)
     return cv2.cvtColor(np.array(pages[pageno]), cv2.COLOR_RGB2GRAY)
 
@@ -116,7 +132,12 @@ def load_some(*paths: str, width: int = 1200) -> List[MatLike]:
     return [transform(load_numpy(Path(path))) for path in paths]
 
 
-def denoise(image: MatLike, block_size: int = 11, C: int = 2) -> MatLike:
+def denoise(
+    image: MatLike,
+    block_size: int = 11,
+    C: int = 2,
+    dst: Optional[MatLike] = None
+) -> MatLike:
     if block_size > 0:
         return cv2.adaptiveThreshold(
             image,
@@ -124,17 +145,168 @@ def denoise(image: MatLike, block_size: int = 11, C: int = 2) -> MatLike:
             adaptiveMethod=cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
             thresholdType=cv2.THRESH_BINARY,
             blockSize=block_size,
-            C=C
+            C=C,
+            dst=dst
         )
     else:
         _, image = cv2.threshold(
             image,
             127, 255,
-            cv2.THRESH_OTSU
+            cv2.THRESH_OTSU,
+            dst=dst
         )
         return image
 
 
+def best_angle(
+    image: MatLike,
+    angles: np.ndarray,
+    max_samples: int = 200_000
+) -> float:
+    # Projects the dark pixels of IMAGE onto rows for all ANGLES at once, and
+    # returns the angle giving the peakiest profile. Thin lines turn gray once
+    # downsampled, so pixels are weighted by their darkness rather than
+    # thresholded.
+    ys, xs = np.nonzero(image < 224)
+    if ys.size == 0:
+        return 0.0
+    if ys.size > max_samples:
+        pick = np.random.default_rng(0).choice(
+            ys.size, max_samples, replace=False)
+        ys, xs = ys[pick], xs[pick]
+    darkness = 255.0 - image[ys, xs]
+    rows = ys - np.tan(np.radians(angles))[:, None] * xs
+    rows -= np.floor(rows.min(axis=1, keepdims=True))
+    # Pixels are split between their two nearest rows, which keeps small
+    # angles from being lost to rounding.
+    lows = np.floor(rows)
+    weights = ((rows - lows) * darkness).ravel()
+    darkness = np.broadcast_to(darkness, rows.shape).ravel()
+    height = int(lows.max()) + 2
+    lows = (lows + np.arange(len(angles))[:, None] * height).astype(np.int64)
+    lows = lows.ravel()
+    size = len(angles) * height
+    profiles = (
+        np.bincount(lows, weights=darkness - weights, minlength=size) +
+        np.bincount(lows + 1, weights=weights, minlength=size)
+    ).reshape(len(angles), height)
+    return float(angles[np.argmax(np.sum(profiles ** 2, axis=1))])
+
+
+def estimate_skew(
+    image: MatLike,
+    max_angle: float = 2.0,
+    step: float = 0.02,
+    width: int = 400
+) -> float:
+    # Angle, in degrees, by which IMAGE should be rotated for its staff lines
+    # to be horizontal. The search runs in two passes: the whole angle range
+    # is scanned in coarse steps on a page downsampled to WIDTH, and the best
+    # angle found is refined on a page four times larger.
+    def downsample(width: int) -> MatLike:
+        scale = min(1.0, width / image.shape[1])
+        return cv2.resize(image, None, fx=scale, fy=scale,
+                          interpolation=cv2.INTER_AREA)
+    coarse_step = 5 * step
+    angle = best_angle(
+        downsample(width),
+        np.round(np.arange(-max_angle, max_angle + coarse_step / 2,
+                           coarse_step), 6)
+    )
+    angle = best_angle(
+        downsample(4 * width),
+        np.round(np.arange(angle - 2 * coarse_step,
+                           angle + 2 * coarse_step + step / 2, step), 6)
+    )
+    return angle
+
+
+def deskew(
+    image: MatLike,
+    angle: Optional[float] = None,
+    max_angle: float = 2.0
+) -> Tuple[MatLike, float]:
+    # Rotates IMAGE so that its staff lines are horizontal, returns the
+    # rotated image and the angle used. The angle is estimated unless given,
+    # e.g. as saved by a previous run, see save_angles. Angles don't depend
+    # on the resolution the page is rendered at.
+    if angle is None:
+        angle = estimate_skew(image, max_angle=max_angle)
+    if angle == 0:
+        return image, angle
+    h, w = image.shape[:2]
+    transform = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    return cv2.warpAffine(
+        image, transform, (w, h),
+        flags=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_CONSTANT, borderValue=WHITE
+    ), angle
+
+
+def save_angles(target: Path | str, digest: str, angles: Sequence[float]):
+    # Deskew angles of the pages of a pdf, NaN for pages not deskewed, along
+    # with the digest of the pdf they were estimated on.
+    np.savez(target, digest=digest, angles=np.asarray(angles, dtype=np.float64))
+
+
+def load_angles(source: Path | str, digest: str) -> Optional[np.ndarray]:
+    # The angles saved for the pdf of DIGEST, None when there are none or
+    # they were estimated on another version of it.
+    if not Path(source).exists():
+        return None
+    with np.load(source) as data:
+        if str(data["digest"]) != digest:
+            return None
+        return data["angles"]
+
+
+def scaled_height(image: MatLike, width: int) -> int:
+    h, w = image.shape[:2]
+    return int(h * (width / w))
+
+
+@profiling.timed("pdf.preprocess")
+def preprocess_batch(
+    images: Sequence[MatLike],
+    width: int = 1200,
+    block_size: int = 11,
+    C: int = 2,
+    jobs: Optional[int] = None,
+    out: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Resizes and denoises a stack of pages into a single contiguous
+    # (pages, height, width) uint8 array, padding shorter pages with white.
+    # Returns that array and the actual height of each page. Passing the
+    # array returned by a previous call as OUT reuses it when it is large
+    # enough.
+    heights = np.array([scaled_height(image, width)
+                       for image in images], dtype=np.int32)
+    height = int(heights.max(initial=0))
+    if (out is None or out.dtype != np.uint8 or not out.flags.c_contiguous or
+            out.ndim != 3 or out.shape[0] < len(images) or
+            out.shape[1] < height or out.shape[2] != width):
+        out = np.empty((len(images), height, width), dtype=np.uint8)
+    pages = out[:len(images)]
+
+    def transform(idx: int):
+        page = pages[idx, :heights[idx]]
+        cv2.resize(images[idx], (width, int(heights[idx])),
+                   dst=page, interpolation=cv2.INTER_AREA)
+        denoise(page, block_size=block_size, C=C, dst=page)
+        pages[idx, heights[idx]:] = 255
+
+    # Pages are processed concurrently as OpenCV releases the GIL, so we
+    # keep OpenCV itself single threaded to avoid oversubscription.
+    threads = cv2.getNumThreads()
+    cv2.setNumThreads(1)
+    try:
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+            list(pool.map(transform, range(len(images))))
+    finally:
+        cv2.setNumThreads(threads)
+    return pages, heights
+
+
 def create_staff(
     staff: Staff,
     shape: Optional[Tuple[int, int]] = None,
@@ -199,32 +371,68 @@ def line_indices(lines: MatLike) -> List[Tuple[int, int]]:
     return out
 
 
-def find_staff(image: MatLike) -> Staff:
-    staff = Staff(
-        top_offset=0,
-        left=0, right=0,
-        positions=[],
-    )
-#    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (50, 1))
-#    lines = cv2.morphologyEx(image, cv2.MORPH_CLOSE, kernel)
-    lines = image
-    lines = cv2.bitwise_not(lines)
-    y_lines = np.sum(lines, 1)
-    x_lines = np.sum(lines, 0)
-
-    if False:
-        plt.plot(y_lines)
-        plt.show()
-
-    # Left and right are top and last offsets of vertical lines.
-    x = np.nonzero(x_lines)[0]
-    if x.size == 0:
-        raise ValueError(f"margin-detection: we got a blank image?")
-    staff = replace(staff, left=x[0], right=x[-1])
-
+class PageProfile:
+    # Summed-area table of the inverted page: row and column projections of
+    # any sub-rectangle cost one subtraction per entry, without summing its
+    # pixels again.
+
+    table: np.ndarray
+    height: int
+    width: int
+
+    def __init__(self, image: MatLike):
+        self.height, self.width = image.shape[:2]
+        self.table = cv2.integral(cv2.bitwise_not(image), sdepth=cv2.CV_64F)
+
+    def clip(
+        self,
+        top: int, bot: Optional[int],
+        left: int, right: Optional[int]
+    ) -> Tuple[int, int, int, int]:
+        bot = self.height if bot is None else min(bot, self.height)
+        right = self.width if right is None else min(right, self.width)
+        return max(top, 0), bot, max(left, 0), right
+
+    def total(
+        self,
+        top: int = 0, bot: Optional[int] = None,
+        left: int = 0, right: Optional[int] = None
+    ) -> float:
+        top, bot, left, right = self.clip(top, bot, left, right)
+        t = self.table
+        return float(t[bot, right] - t[bot, left] - t[top, right] + t[top, left])
+
+    def rows(
+        self,
+        top: int = 0, bot: Optional[int] = None,
+        left: int = 0, right: Optional[int] = None
+    ) -> np.ndarray:
+        # Sum of each row in [top, bot) restricted to columns [left, right).
+        top, bot, left, right = self.clip(top, bot, left, right)
+        t = self.table
+        span = t[top:bot + 1, right] - t[top:bot + 1, left]
+        return span[1:] - span[:-1]
+
+    def cols(
+        self,
+        top: int = 0, bot: Optional[int] = None,
+        left: int = 0, right: Optional[int] = None
+    ) -> np.ndarray:
+        # Sum of each column in [left, right) restricted to rows [top, bot).
+        top, bot, left, right = self.clip(top, bot, left, right)
+        t = self.table
+        span = t[bot, left:right + 1] - t[top, left:right + 1]
+        return span[1:] - span[:-1]
+
+
+def find_lines(y_lines: np.ndarray, max_iterations: int = 32) -> np.ndarray:
+    # Offsets of the staff lines in a row projection, the detection threshold
+    # is adjusted until the number of lines is a multiple of 10. Gives up
+    # after MAX_ITERATIONS adjustments, e.g. on a skewed page, leaving it to
+    # the caller to reject the lines found.
     fudge = 0.6
     fudge_step = 0.05
-    while True:
+    for iteration in range(max_iterations):
         high = fudge * np.max(y_lines)
         # Candidates horizontal lines.
         lines = np.where(y_lines > high)[0]
@@ -239,17 +447,126 @@ def find_staff(image: MatLike) -> Staff:
             # Increase the fudge to get less lines.
             fudge += fudge_step
             fudge_step /= 2
-        print(f"fudge {fudge}")
+    if profiling.ENABLED:
+        profiling.count("pdf.find_lines")
+        profiling.count("pdf.fudge_iterations", iteration + 1)
+    return lines
 
-    staff = replace(staff, top_offset=lines[0])
 
+def staff_from_lines(lines: np.ndarray, x_lines: np.ndarray) -> Staff:
+    # Left and right are top and last offsets of vertical lines.
+    x = np.nonzero(x_lines)[0]
+    if x.size == 0:
+        raise ValueError("margin-detection: we got a blank image?")
     if lines.size % 10 != 0:
         raise ValueError(f"Number of lines {
                          lines.size} should be divisible by 10.")
-    else:
-        staff = replace(staff, positions=[
-                        (lines[ridx], lines[lidx]) for ridx, lidx in line_indices(lines)])
-    return staff
+    return Staff(
+        top_offset=lines[0],
+        left=x[0], right=x[-1],
+        positions=[(lines[ridx], lines[lidx])
+                   for ridx, lidx in line_indices(lines)],
+    )
+
+
+@profiling.timed("pdf.find_staff")
+def find_staff(image: MatLike, profile: Optional[PageProfile] = None) -> Staff:
+#    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (50, 1))
+#    lines = cv2.morphologyEx(image, cv2.MORPH_CLOSE, kernel)
+    profile = profile or PageProfile(image)
+    y_lines = profile.rows()
+    x_lines = profile.cols()
+
+    if False:
+        import matplotlib.pyplot as plt
+        plt.plot(y_lines)
+        plt.show()
+
+    return staff_from_lines(find_lines(y_lines), x_lines)
+
+
+def find_bands(
+    image: MatLike,
+    levels: int = 2,
+    threshold: float = 0.2,
+    margin: int = 2
+) -> np.ndarray:
+    # Locates the horizontal bands holding staff lines on a copy of IMAGE
+    # downsampled by 2**levels, returns their (top, bottom) rows in IMAGE.
+    coarse = image
+    for _ in range(levels):
+        coarse = cv2.pyrDown(coarse)
+    y_coarse = np.sum(cv2.bitwise_not(coarse), 1, dtype=np.int64)
+    dark = np.concatenate(
+        ([False], y_coarse > threshold * np.max(y_coarse), [False]))
+    edges = np.flatnonzero(np.diff(dark.astype(np.int8)))
+    bands = edges.reshape(-1, 2)
+    bands[:, 0] -= margin
+    bands[:, 1] += margin
+    bands = np.clip(bands << levels, 0, image.shape[0])
+    if len(bands) > 1:
+        # Merges bands overlapping once their margins are added.
+        starts = np.concatenate(([True], bands[1:, 0] > bands[:-1, 1]))
+        ends = np.concatenate((starts[1:], [True]))
+        bands = np.stack((bands[starts, 0], bands[ends, 1]), axis=1)
+    return bands
+
+
+def find_staff_pyramid(image: MatLike, levels: int = 2) -> Staff:
+    # Coarse to fine find_staff for large pages: staff bands are located on a
+    # downsampled page, and staff lines are only searched for at full
+    # resolution within these bands.
+    y_lines = np.zeros(image.shape[0], dtype=np.int64)
+    x_lines = np.zeros(image.shape[1], dtype=np.int64)
+    for top, bot in find_bands(image, levels):
+        band = cv2.bitwise_not(image[top:bot])
+        y_lines[top:bot] = np.sum(band, 1, dtype=np.int64)
+        x_lines += np.sum(band, 0, dtype=np.int64)
+    return staff_from_lines(find_lines(y_lines), x_lines)
+
+
+@profiling.timed("pdf.find_bars")
+def find_bars(
+    profile: PageProfile,
+    staff: Staff,
+    fill: float = 0.9,
+    min_gap: int = 5
+) -> List[np.ndarray]:
+    # Returns, for each system, the x offsets of its bar lines: columns dark
+    # over at least FILL of the system's height, from rh_top to lh_bot. All
+    # systems are projected at once from the page's summed-area table.
+    positions = np.array(staff.positions, dtype=np.int64).reshape(-1, 2)
+    if len(positions) == 0:
+        return []
+    left, right = staff.left, min(staff.right + 1, profile.width)
+    tops = positions[:, 0]
+    bots = np.minimum(positions[:, 1] + 1, profile.height)
+    table = profile.table
+    cols = np.diff(table[bots, left:right + 1] -
+                   table[tops, left:right + 1], axis=1)
+    dark = cols >= (fill * 255 * (bots - tops))[:, None]
+    systems, xs = np.nonzero(dark)
+    # Thick bar lines span several columns, only keep the first of each run.
+    keep = np.ones(xs.size, dtype=bool)
+    keep[1:] = (systems[1:] != systems[:-1]) | (np.diff(xs) > min_gap)
+    systems, xs = systems[keep], xs[keep] + left
+    counts = np.bincount(systems, minlength=len(positions))
+    return np.split(xs, np.cumsum(counts)[:-1])
+
+
+def bar_counts(
+    bars: Sequence[np.ndarray],
+    lefts: np.ndarray | int,
+    margin: int = 10
+) -> np.ndarray:
+    # Number of bars in each system, i.e. the intervals between its bar
+    # lines. The left edge of the system opens the first bar when no bar line
+    # is drawn there.
+    lefts = np.broadcast_to(np.asarray(lefts), (len(bars),))
+    counts = np.array([len(xs) for xs in bars], dtype=np.int32)
+    firsts = np.array([xs[0] if len(xs) else -1 for xs in bars])
+    opened = (counts > 0) & (firsts - lefts <= margin)
+    return np.maximum(counts - opened, 0).astype(np.int32)
 
 
 def histo(a: MatLike) -> bool:
@@ -259,35 +576,143 @@ def histo(a: MatLike) -> bool:
     return len(values) == 2 and values[0] == 0 and values[1] == 255
 
 
-def cut_sheet(image: MatLike, staff: Staff) -> List[MatLike]:
-    interstaff = 0
-    for (rh_top, _), (_, lh_bot) in zip(staff.positions[1:], staff.positions[:-1]):
-        interstaff += (rh_top - lh_bot)
-    interstaff //= len(staff.positions) - 1
-    rolls = []
-    for rh_top, lh_bot in staff.positions:
-        top = rh_top - interstaff // 2
-        bot = lh_bot + interstaff // 2
-        rolls.append(image[top:bot, staff.left:staff.right])
-        if show(rolls[-1]):
-            break
-    return rolls
+def line_boxes(image: MatLike, staff: Staff) -> np.ndarray:
+    # Returns one (top, bottom, left, right) row per system, extended by half
+    # the average gap between systems and clipped to the image.
+    positions = np.array(staff.positions, dtype=np.int32).reshape(-1, 2)
+    if len(positions) > 1:
+        interstaff = int(np.sum(positions[1:, 0] - positions[:-1, 1]))
+        interstaff //= len(positions) - 1
+    else:
+        # A single system, use its own height as the margin.
+        interstaff = int(np.sum(positions[:, 1] - positions[:, 0]))
+    boxes = np.empty((len(positions), 4), dtype=np.int32)
+    boxes[:, 0] = np.maximum(positions[:, 0] - interstaff // 2, 0)
+    boxes[:, 1] = np.minimum(positions[:, 1] + interstaff // 2, image.shape[0])
+    boxes[:, 2] = staff.left
+    boxes[:, 3] = staff.right
+    return boxes
+
+
+def cut_sheet(
+    image: MatLike,
+    staff: Staff,
+    interactive: bool = True
+) -> Tuple[np.ndarray, List[MatLike]]:
+    # Returns the system boxes and the matching crops, which are views into
+    # IMAGE. When INTERACTIVE, each crop is displayed in turn.
+    boxes = line_boxes(image, staff)
+    rolls = [image[top:bot, left:right] for top, bot, left, right in boxes]
+    if interactive:
+        for roll in rolls:
+            if show(roll):
+                break
+    return boxes, rolls
+
+
+def fit_height(
+    crop: MatLike,
+    height: int,
+    resize: bool = False
+) -> MatLike:
+    # Brings CROP to HEIGHT rows, either by scaling it or by centering it
+    # vertically (cropping the excess or padding with white).
+    h, w = crop.shape[:2]
+    if resize:
+        return cv2.resize(crop, (max(1, round(w * height / h)), height),
+                          interpolation=cv2.INTER_AREA)
+    if h >= height:
+        top = (h - height) // 2
+        return crop[top:top + height]
+    out = np.full((height, w), 255, dtype=np.uint8)
+    top = (height - h) // 2
+    out[top:top + h] = crop
+    return out
+
+
+def crops_path(target: Path | str) -> Tuple[Path, Path]:
+    target = Path(target)
+    return target.with_suffix(".npy"), target.with_suffix(".index.npz")
+
+
+@profiling.timed("pdf.export")
+def export_crops(
+    target: Path | str,
+    crops: Sequence[MatLike],
+    boxes: np.ndarray,
+    pages: Optional[np.ndarray] = None,
+    bars: Optional[Sequence[np.ndarray]] = None,
+    height: int = 256,
+    width: Optional[int] = None,
+    resize: bool = False,
+):
+    # Writes all CROPS as a single (count, height, width) uint8 tensor, padded
+    # to the right with white, along with an index holding for each crop its
+    # page number, its box in the page and its width in the tensor. When BARS
+    # holds the bar lines of each crop (as from find_bars), the index also
+    # gets each crop's bar count and its bar offsets relative to the crop.
+    tensor_path, index_path = crops_path(target)
+    fitted = [fit_height(crop, height, resize) for crop in crops]
+    widths = np.array([crop.shape[1] for crop in fitted], dtype=np.int32)
+    if width is None:
+        width = int(widths.max(initial=0))
+    np.minimum(widths, width, out=widths)
+    tensor = np.lib.format.open_memmap(
+        tensor_path, mode="w+", dtype=np.uint8,
+        shape=(len(fitted), height, width)
+    )
+    tensor[...] = 255
+    for idx, crop in enumerate(fitted):
+        tensor[idx, :, :widths[idx]] = crop[:, :widths[idx]]
+    tensor.flush()
+    del tensor
+    if pages is None:
+        pages = np.zeros(len(fitted), dtype=np.int32)
+    boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+    index = dict(
+        pages=np.asarray(pages, dtype=np.int32),
+        boxes=boxes,
+        widths=widths,
+    )
+    if bars is not None:
+        lengths = np.array([len(xs) for xs in bars], dtype=np.int64)
+        index.update(
+            bar_counts=bar_counts(bars, boxes[:, 2]),
+            bar_offsets=np.concatenate(([0], np.cumsum(lengths))),
+            bar_xs=np.concatenate(
+                [np.asarray(xs, dtype=np.int32) - left
+                 for xs, left in zip(bars, boxes[:, 2])] +
+                [np.empty(0, dtype=np.int32)]
+            ),
+        )
+    np.savez(index_path, **index)
+
+
+def load_crops(target: Path | str) -> Tuple[np.ndarray, dict]:
+    tensor_path, index_path = crops_path(target)
+    with np.load(index_path) as index:
+        return (
+            np.load(tensor_path, mmap_mode="r"),
+            {key: index[key] for key in index.files}
+        )
 
 
-crop = (800, 1200)
-l = load_some(*[path for _, path, _ in wset])
-tl = [denoise(x, block_size=11) for x in l]
-# st = [find_staff(t) for t in tl]
+def main():
+    crop = (800, 1200)
+    l = load_some(*[path for _, path, _ in wset])
+    tl = [denoise(x, block_size=11) for x in l]
+    # st = [find_staff(t) for t in tl]
 
-# compare(tl, st, crop)
+    # compare(tl, st, crop)
 
+    # img = create_staff((1552, 1200), default_staff)
+    # show(img)
+    for image in tl:
+        staff = find_staff(image)
+        cut_sheet(image, staff)
+        # if show(create_staff(staff, background=image.copy())):
+        #     break
 
-# img = create_staff((1552, 1200), default_staff)
-# show(img)
-for image in tl:
-    staff = find_staff(image)
-    cut_sheet(image, staff)
-    # if show(create_staff(staff, background=image.copy())):
-    #     break
 
-sys.exit(0)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# Piano rolls of a normalized midi timeline, see midinorm.NOTE_DTYPE. Rolls
+# have one row per frame and one column per midi note, either as a dense
+# uint8 array or in compressed sparse row (CSR) form, and can be written
+# straight to memory mapped .npy files.
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from intervals import ranges
+
+NOTES = 128
+
+
+def note_frames(
+    notes: np.ndarray,
+    resolution: int = 0,
+    bounds: Optional[np.ndarray] = None,
+    frames: int = 48
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    # Frame range [start, end) of each note, and the number of frames. Frames
+    # either last RESOLUTION ticks, or split each segment between consecutive
+    # BOUNDS (e.g. bar or line clocks) into FRAMES equal parts. Notes are at
+    # least one frame long, notes outside of BOUNDS get an empty range.
+    starts = notes["clock"].astype(np.float64)
+    ends = starts + notes["duration"]
+    if bounds is None:
+        assert resolution > 0, "One of RESOLUTION or BOUNDS must be provided."
+        count = int(-(-ends.max(initial=0) // resolution))
+        starts, ends = starts / resolution, ends / resolution
+    else:
+        count = (len(bounds) - 1) * frames
+        positions = np.arange(len(bounds)) * frames
+        inside = (ends > bounds[0]) & (starts < bounds[-1])
+        starts = np.where(inside, np.interp(starts, bounds, positions), 0)
+        ends = np.where(inside, np.interp(ends, bounds, positions), 0)
+    first = np.floor(starts).astype(np.int64)
+    last = np.maximum(np.ceil(ends).astype(np.int64), first + 1)
+    if bounds is not None:
+        last[~inside] = first[~inside]
+    return first, np.minimum(last, count), count
+
+
+def active_cells(
+    notes: np.ndarray,
+    first: np.ndarray,
+    last: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Rows, columns and note index of every (frame, note) cell played.
+    owners, rows = ranges(first, last)
+    return rows, notes["note"][owners].astype(np.int64), owners
+
+
+def dense_roll(
+    notes: np.ndarray,
+    resolution: int = 0,
+    bounds: Optional[np.ndarray] = None,
+    frames: int = 48,
+    path: Optional[Path | str] = None,
+    value: int = 1
+) -> np.ndarray:
+    # Dense uint8 roll of NOTES, see note_frames for the frame layout. With
+    # BOUNDS the roll is shaped (segments, frames, 128), otherwise (frames,
+    # 128). When PATH is given, the roll is a memory map of that .npy file.
+    first, last, count = note_frames(notes, resolution, bounds, frames)
+    shape = (count, NOTES)
+    if path is None:
+        roll = np.zeros(shape, dtype=np.uint8)
+    else:
+        roll = np.lib.format.open_memmap(
+            path, mode="w+", dtype=np.uint8, shape=shape)
+    rows, cols, _ = active_cells(notes, first, last)
+    roll[rows, cols] = value
+    if bounds is not None:
+        roll = roll.reshape(len(bounds) - 1, frames, NOTES)
+    return roll
+
+
+@dataclass
+class SparseRoll:
+    indptr: np.ndarray      # Row i spans indices[indptr[i]:indptr[i+1]]
+    indices: np.ndarray     # Column, i.e. the midi note, of each cell.
+    data: np.ndarray        # Value of each cell.
+    shape: Tuple[int, int]
+
+    def row(self, idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.indptr[idx], self.indptr[idx + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def rows(self, start: int, end: int) -> "SparseRoll":
+        # Frames [start, end) as a view of this roll, e.g. a bar or a line.
+        lo, hi = self.indptr[start], self.indptr[end]
+        return SparseRoll(
+            self.indptr[start:end + 1] - lo,
+            self.indices[lo:hi],
+            self.data[lo:hi],
+            (end - start, self.shape[1])
+        )
+
+    def todense(self) -> np.ndarray:
+        roll = np.zeros(self.shape, dtype=self.data.dtype)
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        roll[rows, self.indices] = self.data
+        return roll
+
+
+SPARSE_FILES = ("indptr", "indices", "data")
+
+
+def sparse_roll(
+    notes: np.ndarray,
+    resolution: int = 0,
+    bounds: Optional[np.ndarray] = None,
+    frames: int = 48,
+    path: Optional[Path | str] = None,
+    value: int = 1
+) -> SparseRoll:
+    # CSR roll of NOTES, for long pieces where most of the dense roll would
+    # be empty. With BOUNDS, segment s spans rows [s * frames, (s+1) *
+    # frames). When PATH is given, it is a directory where the arrays are
+    # written as memory mapped .npy files.
+    first, last, count = note_frames(notes, resolution, bounds, frames)
+    rows, cols, _ = active_cells(notes, first, last)
+    # Sorts cells by row then column, merging overlapping notes (sorting is
+    # much faster than np.unique here).
+    cells = np.sort(rows * NOTES + cols)
+    keep = np.ones(len(cells), dtype=bool)
+    keep[1:] = cells[1:] != cells[:-1]
+    cells = cells[keep]
+    arrays = dict(
+        indptr=np.concatenate(
+            ([0], np.cumsum(np.bincount(cells // NOTES, minlength=count)))),
+        indices=(cells % NOTES).astype(np.uint8),
+        data=np.full(len(cells), value, dtype=np.uint8),
+    )
+    if path is not None:
+        Path(path).mkdir(parents=True, exist_ok=True)
+        for name in SPARSE_FILES:
+            mapped = np.lib.format.open_memmap(
+                Path(path) / f"{name}.npy", mode="w+",
+                dtype=arrays[name].dtype, shape=arrays[name].shape)
+            mapped[...] = arrays[name]
+            arrays[name] = mapped
+    return SparseRoll(
+        arrays["indptr"], arrays["indices"], arrays["data"], (count, NOTES))
+
+
+def load_sparse_roll(path: Path | str) -> SparseRoll:
+    arrays: List[np.ndarray] = [
+        np.load(Path(path) / f"{name}.npy", mmap_mode="r")
+        for name in SPARSE_FILES
+    ]
+    return SparseRoll(*arrays, (len(arrays[0]) - 1, NOTES))
@@ -0,0 +1,197 @@
+# Lightweight instrumentation: named counters and timers that the pipeline
+# stages update when ENABLED, and cProfile runs dumped as pstats files.
+# Instrumented code tests ENABLED before recording anything, and records per
+# track, file or page rather than per event, so that leaving it in costs
+# next to nothing when profiling is off.
+import cProfile
+import json
+import os
+import pstats
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+ENABLED = False
+
+COUNTERS: Dict[str, int] = defaultdict(int)
+# Accumulated seconds and number of calls of each timer.
+SECONDS: Dict[str, float] = defaultdict(float)
+CALLS: Dict[str, int] = defaultdict(int)
+
+F = TypeVar("F", bound=Callable)
+
+
+def enable(enabled: bool = True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def reset():
+    COUNTERS.clear()
+    SECONDS.clear()
+    CALLS.clear()
+
+
+def count(name: str, value: int = 1):
+    COUNTERS[name] += value
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        SECONDS[name] += time.perf_counter() - start
+        CALLS[name] += 1
+
+
+def timed(name: str) -> Callable[[F], F]:
+    # Decorator timing each call of the function under NAME.
+    def decorator(fn: F) -> F:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                SECONDS[name] += time.perf_counter() - start
+                CALLS[name] += 1
+        return wrapper  # type: ignore
+    return decorator
+
+
+def report() -> dict:
+    return dict(
+        counters=dict(sorted(COUNTERS.items())),
+        timers={name: dict(seconds=SECONDS[name], calls=CALLS[name])
+                for name in sorted(SECONDS)},
+    )
+
+
+def merge(total: dict, other: dict) -> dict:
+    # Adds the report OTHER, e.g. from a worker process, into TOTAL.
+    counters = total.setdefault("counters", {})
+    for name, value in other.get("counters", {}).items():
+        counters[name] = counters.get(name, 0) + value
+    timers = total.setdefault("timers", {})
+    for name, value in other.get("timers", {}).items():
+        timer = timers.setdefault(name, dict(seconds=0.0, calls=0))
+        timer["seconds"] += value["seconds"]
+        timer["calls"] += value["calls"]
+    return total
+
+
+def save_report(target: Path | str, total: Optional[dict] = None):
+    with open(target, "w") as f:
+        json.dump(report() if total is None else total, f, indent=2)
+        f.write("\n")
+
+
+@contextmanager
+def profile(target: Path | str) -> Iterator[cProfile.Profile]:
+    # Runs the block under cProfile and dumps its pstats into TARGET.
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(target)
+
+
+def stats_path(stats_dir: Path | str) -> str:
+    # A new file in STATS_DIR to dump the stats of a cProfile run into.
+    fd, stats = tempfile.mkstemp(suffix=".prof", dir=stats_dir)
+    os.close(fd)
+    return stats
+
+
+class Profiled:
+    # Applies FN to a list of inputs in a worker process, see Session. With
+    # COUNTERS, the counters and timers are enabled and their report returned
+    # along with the results. With STATS_DIR, FN runs under cProfile into its
+    # own stats file there.
+
+    fn: Callable[[list], list]
+    counters: bool
+    stats_dir: Optional[str]
+
+    def __init__(
+        self,
+        fn: Callable[[list], list],
+        counters: bool,
+        stats_dir: Optional[str]
+    ):
+        self.fn = fn
+        self.counters = counters
+        self.stats_dir = stats_dir
+
+    def __call__(self, inputs: list) -> Tuple[list, Optional[dict]]:
+        enable(self.counters)
+        reset()
+        with ExitStack() as stack:
+            if self.stats_dir:
+                stack.enter_context(profile(stats_path(self.stats_dir)))
+            results = self.fn(inputs)
+        return results, report() if self.counters else None
+
+
+class Session:
+    # Profile of work spread over worker processes, written to TARGET on
+    # exit: the merged counters and timers when it ends with .json, the
+    # merged cProfile stats otherwise. Nothing is recorded without TARGET.
+
+    target: Optional[Path]
+    counters: bool
+    stats_dir: Optional[str]
+    total: dict
+    stack: ExitStack
+
+    def __init__(self, target: Optional[Path | str]):
+        self.target = None if target is None else Path(target)
+        self.counters = self.target is not None and self.target.suffix == ".json"
+        self.stats_dir = None
+        self.total = {}
+        self.stack = ExitStack()
+
+    def __enter__(self) -> "Session":
+        if self.target is not None and not self.counters:
+            self.stats_dir = self.stack.enter_context(
+                tempfile.TemporaryDirectory(prefix="omr-profile-"))
+        return self
+
+    def __exit__(self, *args):
+        # Inputs processed inline enabled the counters in this process.
+        enable(False)
+        with self.stack:
+            if self.counters:
+                save_report(self.target, self.total)
+            elif self.stats_dir:
+                files = sorted(Path(self.stats_dir).glob("*.prof"))
+                if files:
+                    pstats.Stats(*map(str, files)).dump_stats(self.target)
+
+    def wrap(self, fn: Callable[[list], list]) -> Callable:
+        # FN profiled as asked, its results to be passed through collect().
+        if self.target is None:
+            return fn
+        return Profiled(fn, self.counters, self.stats_dir)
+
+    def collect(self, output) -> list:
+        # The results of a call of wrap(FN), merging its report.
+        if self.target is None:
+            return output
+        results, counters = output
+        if counters:
+            merge(self.total, counters)
+        return results
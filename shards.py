@@ -0,0 +1,200 @@
+# Training samples, pairs of a line image and its token array, packed into
+# large shard files. A shard holds the raw samples back to back, followed by
+# an index of their offsets and shapes and a fixed size trailer pointing to
+# that index:
+#   [image 0][tokens 0]...[image n-1][tokens n-1][index][trailer]
+# Readers memory map the shards, so that samples are views into the page
+# cache and nothing gets decoded or unpickled.
+import mmap
+from pathlib import Path
+from typing import Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+MAGIC = b"OMRSHRD1"
+ALIGNMENT = 8
+
+INDEX_DTYPE = np.dtype([
+    ("image", "<u8"),       # Offset of the image.
+    ("height", "<u4"),
+    ("width", "<u4"),
+    ("tokens", "<u8"),      # Offset of the tokens.
+    ("length", "<u8"),      # Number of tokens.
+])
+TRAILER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("index", "<u8"),       # Offset of the index.
+    ("count", "<u8"),
+])
+TOKEN_DTYPE = np.dtype("<i4")
+
+
+class ShardWriter:
+
+    directory: Path
+    prefix: str
+    shard_size: int
+    shards: List[Path]
+
+    def __init__(
+        self,
+        directory: Path | str,
+        prefix: str = "shard",
+        shard_size: int = 256 << 20
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shards = []
+        self.file = None
+        self.entries: List[Tuple[int, int, int, int, int]] = []
+
+    def __enter__(self) -> "ShardWriter":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data: bytes | memoryview) -> int:
+        assert self.file is not None
+        offset = self.file.tell()
+        self.file.write(data)
+        if (padding := -self.file.tell() % ALIGNMENT):
+            self.file.write(b"\0" * padding)
+        return offset
+
+    def add(self, image: np.ndarray, tokens: np.ndarray):
+        # Adds a (height, width) uint8 IMAGE and its TOKENS, starting a new
+        # shard once the current one is over shard_size.
+        assert image.ndim == 2 and image.dtype == np.uint8, \
+            "Images are expected to be 2D uint8 arrays."
+        if self.file is None:
+            path = self.directory / f"{self.prefix}-{len(self.shards):05d}.bin"
+            self.shards.append(path)
+            self.file = open(path, "wb")
+        tokens = np.ascontiguousarray(tokens, dtype=TOKEN_DTYPE)
+        image_offset = self.write(np.ascontiguousarray(image).data)
+        tokens_offset = self.write(tokens.data)
+        self.entries.append(
+            (image_offset, image.shape[0], image.shape[1], tokens_offset, len(tokens)))
+        if self.file.tell() >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        # Completes the current shard with its index and trailer.
+        if self.file is None:
+            return
+        index = np.array(self.entries, dtype=INDEX_DTYPE)
+        offset = self.write(index.tobytes())
+        trailer = np.array([(MAGIC, offset, len(index))], dtype=TRAILER_DTYPE)
+        self.file.write(trailer.tobytes())
+        self.file.close()
+        self.file = None
+        self.entries = []
+
+    def close(self):
+        self.flush()
+
+
+class Shard:
+
+    path: Path
+    map: mmap.mmap
+    buffer: memoryview
+    index: np.ndarray
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self.map)
+        trailer = np.frombuffer(
+            self.buffer[-TRAILER_DTYPE.itemsize:], dtype=TRAILER_DTYPE)[0]
+        if trailer["magic"] != MAGIC:
+            raise ValueError(f"{self.path}: not a shard file.")
+        # A copy, as views into the buffer would keep it from being closed.
+        self.index = np.frombuffer(
+            self.buffer, dtype=INDEX_DTYPE,
+            count=int(trailer["count"]), offset=int(trailer["index"])).copy()
+        del trailer
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        entry = self.index[idx]
+        height, width = int(entry["height"]), int(entry["width"])
+        image = np.frombuffer(
+            self.buffer, dtype=np.uint8,
+            count=height * width, offset=int(entry["image"])
+        ).reshape(height, width)
+        tokens = np.frombuffer(
+            self.buffer, dtype=TOKEN_DTYPE,
+            count=int(entry["length"]), offset=int(entry["tokens"]))
+        return image, tokens
+
+    def advise(self, advice: str):
+        # Hints the kernel about upcoming accesses, where supported.
+        if (value := getattr(mmap, advice, None)) is not None:
+            self.map.madvise(value)
+
+    def close(self):
+        # Unmaps the shard, which fails while samples read from it are alive.
+        self.buffer.release()
+        self.map.close()
+
+
+class ShardReader:
+
+    shards: List[Shard]
+    offsets: np.ndarray     # Index of the first sample of each shard.
+
+    def __init__(self, paths: Sequence[Path | str] | Path | str):
+        if isinstance(paths, (str, Path)):
+            paths = sorted(Path(paths).glob("*.bin"))
+        self.shards = [Shard(path) for path in paths]
+        self.offsets = np.concatenate(
+            ([0], np.cumsum([len(shard) for shard in self.shards])))
+
+    def __enter__(self) -> "ShardReader":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Random access: the image and tokens of sample IDX, as read only
+        # views into the shard.
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Sample {idx} out of range.")
+        shard = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        return self.shards[shard][idx - int(self.offsets[shard])]
+
+    def stream(
+        self,
+        start: int = 0,
+        readahead: int = 1
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        # Sequential access from sample START, the next READAHEAD shards are
+        # prefetched by the kernel while the current one is consumed.
+        first = int(np.searchsorted(self.offsets, start, side="right")) - 1
+        for idx in range(max(first, 0), len(self.shards)):
+            shard = self.shards[idx]
+            shard.advise("MADV_SEQUENTIAL")
+            for ahead in self.shards[idx + 1:idx + 1 + readahead]:
+                ahead.advise("MADV_WILLNEED")
+            skip = max(start - int(self.offsets[idx]), 0)
+            for sample in range(skip, len(shard)):
+                yield shard[sample]
+
+    def close(self):
+        # Unmaps all shards, which fails while samples read from them are
+        # alive.
+        for shard in self.shards:
+            shard.close()
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from dtw import dtw
+
+
+def features(rng, count):
+    x = rng.random((count, 12))
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def full_dtw_cost(x, y):
+    # Least total cost of a warping path, over the whole cost matrix.
+    costs = 1.0 - x @ y.T
+    n, m = costs.shape
+    total = np.full((n + 1, m + 1), np.inf)
+    total[0, 0] = 0.0
+    for i in range(1, n + 1):
+        for j in range(1, m + 1):
+            total[i, j] = costs[i - 1, j - 1] + min(
+                total[i - 1, j - 1], total[i - 1, j], total[i, j - 1])
+    return total[n, m]
+
+
+def path_cost(x, y, path):
+    return float(np.sum(1.0 - np.einsum("ij,ij->i", x[path[:, 0]], y[path[:, 1]])))
+
+
+def check_path(path, n, m):
+    assert path[0].tolist() == [0, 0]
+    assert path[-1].tolist() == [n - 1, m - 1]
+    steps = np.diff(path, axis=0)
+    assert ((steps == 0) | (steps == 1)).all() and steps.any(axis=1).all()
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_matches_full_dtw(seed):
+    rng = np.random.default_rng(seed)
+    n, m = (int(value) for value in rng.integers(1, 40, 2))
+    x, y = features(rng, n), features(rng, m)
+    # A band wider than Y covers the whole matrix, small blocks exercise
+    # the block boundaries.
+    path = dtw(x, y, radius=m, block=7)
+    check_path(path, n, m)
+    assert path_cost(x, y, path) == pytest.approx(full_dtw_cost(x, y))
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_band_never_beats_full_dtw(seed):
+    rng = np.random.default_rng(seed)
+    n, m = (int(value) for value in rng.integers(20, 60, 2))
+    x, y = features(rng, n), features(rng, m)
+    path = dtw(x, y, radius=3, block=5)
+    check_path(path, n, m)
+    assert path_cost(x, y, path) >= full_dtw_cost(x, y) - 1e-9
+
+
+def test_empty():
+    assert dtw(np.empty((0, 12)), np.ones((3, 12))).shape == (0, 2)
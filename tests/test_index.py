@@ -0,0 +1,87 @@
+import array
+
+import numpy as np
+import pytest
+
+from midi.index import build_index
+from midi.output import MidiOutput
+from midi.typing import CHANNELS
+from midinorm import MidiNorm
+
+DIVISIONS = 480
+
+
+def make_midi(notes, signatures=((0, 3, 4),)):
+    # A format 1 file of a conductor track holding SIGNATURES, as (tick, nn,
+    # den), followed by a track playing NOTES, as (start, end, note).
+    out = MidiOutput()
+    off = out.open_chunk("MThd")
+    out.write_u16(1)        # Format 1, which format() doesn't write.
+    out.number_of_tracks(2)
+    out.ticks_per_quarter_notes(DIVISIONS)
+    out.close_chunk(off)
+    off = out.open_chunk("MTrk")
+    tick = 0
+    for at, nn, den in signatures:
+        out.time_signature(nn, den, dt=at - tick)
+        tick = at
+    out.track_end()
+    out.close_chunk(off)
+    off = out.open_chunk("MTrk")
+    events = sorted([(start, 1, note) for start, _, note in notes] +
+                    [(end, 0, note) for _, end, note in notes])
+    tick = 0
+    for at, on, note in events:
+        if on:
+            out.note_on(CHANNELS[0], note, dt=at - tick)
+        else:
+            out.note_off(CHANNELS[0], note, dt=at - tick)
+        tick = at
+    out.track_end()
+    out.close_chunk(off)
+    return array.array("B", out.buf.tobytes())
+
+
+def random_notes(seed, count=200):
+    # Notes of random lengths, those of a pitch not overlapping each other.
+    rng = np.random.default_rng(seed)
+    notes, free = [], {}
+    for _ in range(count):
+        note = int(rng.integers(48, 60))
+        start = free.get(note, 0) + int(rng.integers(0, 2000))
+        end = start + int(rng.integers(1, 3000))
+        free[note] = end
+        notes.append((start, end, note))
+    return notes
+
+
+def parse_range(buf, first, last):
+    parser = MidiNorm(buf, partial=True)
+    parser.parse_range(build_index(buf), first, last)
+    return parser.notes()
+
+
+def test_note_ending_at_range_end():
+    buf = make_midi([(5280, 5760, 60)])
+    notes = parse_range(buf, 2, 4)
+    assert notes[["clock", "duration", "note"]].tolist() == [(5280, 480, 60)]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_parse_range_matches_full_parse(seed):
+    buf = make_midi(random_notes(seed), ((0, 3, 4), (7200, 4, 4)))
+    full = MidiNorm(buf)
+    full.parse()
+    notes = full.notes()
+    index = build_index(buf)
+    assert np.array_equal(index.bars, full.bar_clocks())
+    count = len(index.bars)
+    rng = np.random.default_rng(seed)
+    ranges = [(0, count), (count - 1, count)] + [
+        tuple(sorted(rng.integers(0, count + 1, 2))) for _ in range(20)]
+    for first, last in ranges:
+        stop = index.bars[last] if last < count else np.inf
+        expected = notes[(notes["clock"] >= index.bars[first]) &
+                         (notes["clock"] < stop)]
+        found = parse_range(buf, first, last)
+        assert np.array_equal(np.sort(found), np.sort(expected)), (first, last)
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from intervals import build_tree, ranges
+
+
+def brute_force(starts, ends, lows, highs):
+    # Empty intervals count as a single tick, as in build_tree.
+    ends = np.maximum(ends, starts + 1)
+    return [np.flatnonzero((starts < high) & (ends > low)) if high > low
+            else np.empty(0, dtype=np.int64)
+            for low, high in zip(lows, highs)]
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_query_batch_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    count = int(rng.integers(0, 300))
+    starts = rng.integers(-50, 1000, count)
+    ends = starts + rng.integers(0, 200, count)
+    lows = rng.integers(-100, 1100, 500)
+    highs = lows + rng.integers(-5, 150, 500)
+    tree = build_tree(starts, ends)
+    offsets, indices = tree.query_batch(lows, highs)
+    expected = brute_force(starts, ends, lows, highs)
+    assert len(offsets) == len(lows) + 1
+    for idx, found in enumerate(expected):
+        assert indices[offsets[idx]:offsets[idx + 1]].tolist() == found.tolist()
+
+
+def test_query_and_at():
+    starts = np.array([0, 5, 5, 10, 20])
+    ends = np.array([10, 5, 15, 12, 30])
+    tree = build_tree(starts, ends)
+    assert tree.query(5, 6).tolist() == [0, 1, 2]
+    assert tree.query(12, 20).tolist() == [2]
+    assert tree.query(30, 40).tolist() == []
+    offsets, indices = tree.at(np.array([0, 11, 25]))
+    assert np.split(indices, offsets[1:-1])[1].tolist() == [2, 3]
+
+
+def test_ranges():
+    owners, positions = ranges(np.array([3, 0, 7]), np.array([5, 0, 9]))
+    assert owners.tolist() == [0, 0, 2, 2]
+    assert positions.tolist() == [3, 4, 7, 8]
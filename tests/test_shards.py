@@ -0,0 +1,27 @@
+import numpy as np
+
+from shards import ShardReader, ShardWriter
+
+
+def write_samples(directory, count=10):
+    with ShardWriter(directory, shard_size=1000) as writer:
+        for idx in range(count):
+            writer.add(np.full((10, 20), idx, dtype=np.uint8), np.arange(idx))
+
+
+def test_close_fresh_reader(tmp_path):
+    write_samples(tmp_path)
+    reader = ShardReader(tmp_path)
+    reader.close()
+
+
+def test_random_and_sequential_access(tmp_path):
+    write_samples(tmp_path)
+    with ShardReader(tmp_path) as reader:
+        assert len(reader) == 10
+        image, tokens = reader[7]
+        assert image.shape == (10, 20) and image[0, 0] == 7
+        assert tokens.tolist() == list(range(7))
+        del image, tokens
+        firsts = [int(image[0, 0]) for image, _ in reader.stream(3)]
+        assert firsts == list(range(3, 10))
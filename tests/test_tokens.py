@@ -0,0 +1,53 @@
+import io
+
+import numpy as np
+
+from humdrum import Bar, HumdrumParser
+from tokens import BOS, EOS, decode, encode
+
+SCORE = """\
+**kern\t**kern
+*clefF4\t*clefG2
+*k[f#c#]\t*k[f#c#]
+*M3/4\t*M3/4
+4.C\t8cL
+.\t8dJ
+.\t[8e
+8D\t8e_
+4E 4G\t4.f#]
+=1\t=1
+2G\t4r
+.\t8aq 4a-
+4GG--\t16.bL
+.\t32ccJ
+.\t4r
+=2\t=2
+*-\t*-
+"""
+
+
+def normalized(spine):
+    # Bars decode as plain "=" bars.
+    return [Bar("=") if isinstance(symbol, Bar) else symbol for symbol in spine]
+
+
+def test_round_trip():
+    parser = HumdrumParser(io.StringIO(SCORE))
+    parser.parse()
+    assert len(parser.spines) == 2
+    for spine in parser.spines.values():
+        tokens = encode(spine)
+        assert tokens.dtype == np.int32
+        assert tokens[0] == BOS and tokens[-1] == EOS
+        decoded = decode(tokens)
+        assert decoded == normalized(spine)
+        assert np.array_equal(encode(decoded), tokens)
+
+
+def test_without_bos_and_eos():
+    parser = HumdrumParser(io.StringIO(SCORE))
+    parser.parse()
+    spine = next(iter(parser.spines.values()))
+    tokens = encode(spine, bos=False, eos=False)
+    assert np.array_equal(tokens, encode(spine)[1:-1])
+    assert decode(tokens) == normalized(spine)
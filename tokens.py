@@ -0,0 +1,252 @@
+# Token vocabulary for the symbols parsed by humdrum. Every symbol maps to a
+# short, fixed sequence of tokens which is computed once and then looked up,
+# so that encoding a spine costs a dictionary lookup per symbol:
+#   Clef          CLEF_<pitch>
+#   Key           KEY_<sharps|flats>_<count>
+#   Meter         METER_<numerator>_<denominator>
+#   Bar, Null     BAR, NULL
+#   Rest          REST DUR_<duration>
+#   Note          [TIE_START] [TIE_END] [BEAM_START] [BEAM_END] [GRACE]
+#                 PITCH_<pitch>_<accidental> [DUR_<duration>]
+#   Chord         CHORD_START <note>... CHORD_END
+# Pitches follow the ordering of the humdrum.Pitch Enum.
+import array
+from fractions import Fraction
+from operator import attrgetter
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Type, cast
+
+import numpy as np
+
+import profiling
+from humdrum import (
+    Bar,
+    Chord,
+    Clef,
+    Key,
+    Meter,
+    Note,
+    Null,
+    Pitch,
+    Rest,
+    Symbol,
+    recip_duration,
+)
+
+SPECIALS = (
+    "PAD", "BOS", "EOS", "UNK", "NULL", "BAR", "CHORD_START", "CHORD_END",
+    "REST", "TIE_START", "TIE_END", "BEAM_START", "BEAM_END", "GRACE",
+)
+PITCHES = tuple(Pitch)
+ACCIDENTALS = (-2, -1, 0, 1, 2)
+KEYS = tuple((is_flats, count) for is_flats in (False, True)
+             for count in range(8))
+METERS = tuple((numerator, denominator) for numerator in range(1, 17)
+               for denominator in (1, 2, 4, 8, 16, 32))
+DURATIONS = tuple(sorted({
+    recip_duration(recip, "." * dots)
+    for recip in ("00", "0", "1", "2", "3", "4", "6", "8", "12", "16",
+                  "24", "32", "48", "64", "96", "128")
+    for dots in range(4)
+}, reverse=True))
+
+# Token kinds, see KINDS.
+SPECIAL, CLEF, KEY, METER, DURATION, PITCH = range(6)
+
+VOCABULARY: List[str] = list(SPECIALS)
+KINDS: List[int] = [SPECIAL] * len(SPECIALS)
+# What each token stands for: a Pitch, a (Pitch, accidental) pair, a key,
+# meter or duration tuple, or None for specials.
+VALUES: List[object] = [None] * len(SPECIALS)
+
+
+def extend(kind: int, values: Sequence, name: Callable[[object], str]) -> int:
+    base = len(VOCABULARY)
+    VOCABULARY.extend(name(value) for value in values)
+    KINDS.extend([kind] * len(values))
+    VALUES.extend(values)
+    return base
+
+
+CLEF_BASE = extend(CLEF, PITCHES, lambda p: f"CLEF_{p.name}")
+KEY_BASE = extend(KEY, KEYS, lambda k: f"KEY_{'FLATS' if k[0] else 'SHARPS'}_{k[1]}")
+METER_BASE = extend(METER, METERS, lambda m: f"METER_{m[0]}_{m[1]}")
+DURATION_BASE = extend(DURATION, DURATIONS, lambda d: f"DUR_{d}")
+PITCH_BASE = extend(
+    PITCH,
+    [(pitch, acc) for pitch in PITCHES for acc in ACCIDENTALS],
+    lambda p: f"PITCH_{p[0].name}_{p[1]:+d}")
+
+TOKENS: Dict[str, int] = {name: idx for idx, name in enumerate(VOCABULARY)}
+PAD, BOS, EOS, UNK, NULL, BAR, CHORD_START, CHORD_END, REST, TIE_START, \
+    TIE_END, BEAM_START, BEAM_END, GRACE = range(len(SPECIALS))
+
+PITCH_INDEX = {pitch: idx for idx, pitch in enumerate(PITCHES)}
+KEY_INDEX = {key: idx for idx, key in enumerate(KEYS)}
+METER_INDEX = {meter: idx for idx, meter in enumerate(METERS)}
+DURATION_INDEX = {duration: idx for idx, duration in enumerate(DURATIONS)}
+
+
+def duration_token(duration: Fraction) -> int:
+    idx = DURATION_INDEX.get(duration)
+    return UNK if idx is None else DURATION_BASE + idx
+
+
+def note_tokens(note: Note) -> Tuple[int, ...]:
+    tokens = [flag for flag, on in (
+        (TIE_START, note.starts_legato),
+        (TIE_END, note.ends_legato),
+        (BEAM_START, note.starts_beam),
+        (BEAM_END, note.ends_beam),
+        (GRACE, note.is_gracenote),
+    ) if on]
+    accidental = note.sharps - note.flats
+    if accidental in ACCIDENTALS:
+        tokens.append(PITCH_BASE + len(ACCIDENTALS) * PITCH_INDEX[note.pitch] +
+                      ACCIDENTALS.index(accidental))
+    else:
+        tokens.append(UNK)
+    if note.duration:
+        tokens.append(duration_token(note.duration))
+    return tuple(tokens)
+
+
+# Token sequences by symbol key, filled in as new symbols are encountered.
+CACHE: Dict[tuple, Tuple[int, ...]] = {}
+
+
+# Enum and Fraction hashes are computed in Python, so notes are keyed by the
+# plain values behind them.
+note_key = attrgetter(
+    "pitch._value_", "duration.numerator", "duration.denominator", "flats",
+    "sharps", "starts_legato", "ends_legato", "starts_beam", "ends_beam",
+    "is_gracenote")
+
+
+def encode_note(note: Note) -> Tuple[int, ...]:
+    key = note_key(note)
+    if (tokens := CACHE.get(key)) is None:
+        tokens = CACHE[key] = note_tokens(note)
+    return tokens
+
+
+def encode_chord(chord: Chord) -> Tuple[int, ...]:
+    key = ("chord",) + tuple(note_key(note) for note in chord.notes)
+    if (tokens := CACHE.get(key)) is None:
+        tokens = (CHORD_START,) + tuple(
+            token for note in chord.notes for token in note_tokens(note)
+        ) + (CHORD_END,)
+        CACHE[key] = tokens
+    return tokens
+
+
+def encode_rest(rest: Rest) -> Tuple[int, ...]:
+    return (REST, duration_token(rest.duration))
+
+
+def encode_clef(clef: Clef) -> Tuple[int, ...]:
+    return (CLEF_BASE + PITCH_INDEX[clef.pitch],)
+
+
+def encode_key(key: Key) -> Tuple[int, ...]:
+    idx = KEY_INDEX.get((key.is_flats, key.count))
+    return (UNK if idx is None else KEY_BASE + idx,)
+
+
+def encode_meter(meter: Meter) -> Tuple[int, ...]:
+    idx = METER_INDEX.get((meter.numerator, meter.denominator))
+    return (UNK if idx is None else METER_BASE + idx,)
+
+
+ENCODERS: Dict[Type[Symbol], Callable[..., Tuple[int, ...]]] = {
+    Note: encode_note,
+    Chord: encode_chord,
+    Rest: encode_rest,
+    Bar: lambda _: (BAR,),
+    Null: lambda _: (NULL,),
+    Clef: encode_clef,
+    Key: encode_key,
+    Meter: encode_meter,
+}
+
+
+@profiling.timed("tokens.encode")
+def encode(spine: Sequence[Symbol], bos: bool = True, eos: bool = True) -> np.ndarray:
+    # Encodes a parsed spine into an int32 token array.
+    out = array.array("i", [BOS] if bos else [])
+    encoders, cache = ENCODERS, CACHE
+    for symbol in spine:
+        # Notes are by far the most common symbols, hence the fast path.
+        if type(symbol) is Note and (tokens := cache.get(note_key(symbol))):
+            out.extend(tokens)
+        else:
+            out.extend(encoders[type(symbol)](symbol))
+    if eos:
+        out.append(EOS)
+    return np.frombuffer(out, dtype=np.int32)
+
+
+def decode(tokens: Sequence[int] | np.ndarray) -> List[Symbol]:
+    # Decodes a token array back into symbols, the inverse of encode. Bars
+    # come back as plain "=" bars, unknown tokens are dropped.
+    symbols: List[Symbol] = []
+    chord: Optional[List[Note]] = None
+    flags: set = set()
+    note: Optional[Note] = None
+    rest = False
+
+    def emit(symbol: Symbol):
+        if chord is not None and isinstance(symbol, Note):
+            chord.append(symbol)
+        else:
+            symbols.append(symbol)
+
+    for token in np.asarray(tokens).tolist():
+        kind, value = KINDS[token], VALUES[token]
+        if kind == DURATION:
+            duration = cast(Fraction, value)
+            if note is not None:
+                note.duration = duration
+                note = None
+            elif rest:
+                emit(Rest(duration))
+                rest = False
+            continue
+        note, rest = None, False
+        if kind == PITCH:
+            pitch, accidental = cast(Tuple[Pitch, int], value)
+            note = Note(
+                pitch=pitch,
+                duration=Fraction(0),
+                flats=max(-accidental, 0),
+                sharps=max(accidental, 0),
+                starts_legato=TIE_START in flags,
+                ends_legato=TIE_END in flags,
+                starts_beam=BEAM_START in flags,
+                ends_beam=BEAM_END in flags,
+                is_gracenote=GRACE in flags,
+            )
+            flags = set()
+            emit(note)
+        elif kind == CLEF:
+            emit(Clef(cast(Pitch, value)))
+        elif kind == KEY:
+            is_flats, count = cast(Tuple[bool, int], value)
+            emit(Key(is_flats=is_flats, count=count))
+        elif kind == METER:
+            numerator, denominator = cast(Tuple[int, int], value)
+            emit(Meter(numerator, denominator))
+        elif token in (TIE_START, TIE_END, BEAM_START, BEAM_END, GRACE):
+            flags.add(token)
+        elif token == REST:
+            rest = True
+        elif token == BAR:
+            emit(Bar("="))
+        elif token == NULL:
+            emit(Null())
+        elif token == CHORD_START:
+            chord = []
+        elif token == CHORD_END and chord is not None:
+            symbols.append(Chord(chord))
+            chord = None
+    return symbols
+